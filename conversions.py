@@ -1,56 +1,368 @@
+import importlib.util
 import numpy as np
+import os
 import pandas as pd
 import xml.etree.ElementTree as ET
 from abc import ABC, abstractmethod
+from instrumentation import instrumented, span
+from pandas.api.types import union_categoricals
+from state_tree import StateTree
+from typing import Callable
 
 columns = ['NodeType', 'StateClass', 'Name', 'OverrideCurrentLineDowntime', 'Code', 'Type', 'ShortStopThreshold', 'EnableMeantimeMetrics', 'Override', 'Scope', 'Roles', 'Parent', 'Path']
 
+# Column types of the state table dataframe
+# Repeated strings are stored as categoricals, codes and thresholds as nullable integers so class rows
+# without a code don't turn them into floats, and the flags as nullable booleans
+schema = {
+    'NodeType': 'category',
+    'StateClass': 'category',
+    'Name': 'object',
+    'OverrideCurrentLineDowntime': 'boolean',
+    'Code': 'Int64',
+    'Type': 'category',
+    'ShortStopThreshold': 'Int64',
+    'EnableMeantimeMetrics': 'boolean',
+    'Override': 'category',
+    'Scope': 'category',
+    'Roles': 'object',
+    'Parent': 'category',
+    'Path': 'object',
+    'Error': 'object',
+}
+
+# Converts the columns of a state table dataframe to the schema types in place
+# Empty text is read as a missing value, text that doesn't fit a column's type raises an exception
+def apply_schema(df: pd.DataFrame) -> pd.DataFrame:
+    for column, dtype in schema.items():
+        if column not in df or df[column].dtype == dtype:
+            continue
+        values = df[column]
+        try:
+            if dtype == 'Int64':
+                df[column] = pd.to_numeric(values.where(values != '', None)).astype('Int64')
+            elif dtype == 'boolean':
+                df[column] = to_boolean(values)
+            else:
+                df[column] = values.astype(dtype)
+        except (TypeError, ValueError):
+            raise Exception(f'Invalid {column} values')
+
+    return df
+
+# Converts a column of booleans, 1/0 numbers or true/false text to a nullable boolean column
+# Spreadsheet readers return flag columns with empty cells as 1/0 floats
+def to_boolean(values: pd.Series) -> pd.Series:
+    if pd.api.types.is_bool_dtype(values):
+        return values.astype('boolean')
+    if pd.api.types.is_numeric_dtype(values):
+        if not (values.isin([0, 1]) | values.isna()).all():
+            raise ValueError('Invalid boolean value')
+        return values.astype('boolean')
+
+    flags = values.astype(str).str.lower().map({'true': True, 'false': False})
+    if (flags.isna() & values.notna() & (values != '')).any():
+        raise ValueError('Invalid boolean value')
+    return flags.astype('boolean')
+
+# Converts a boolean column to true/false text with None for missing values
+def boolean_text(values: pd.Series) -> pd.Series:
+    text = pd.Series(np.where(values.fillna(False).to_numpy(dtype=bool), 'true', 'false'), index=values.index, dtype=object)
+    return text.where(values.notna(), None)
+
+# Writes values to the rows at the given positions of a column, adding new values to the categories of categorical columns
+def set_values(df: pd.DataFrame, rows: list, col: int, values: list) -> None:
+    column = df.iloc[:, col]
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        categories = pd.Index(values).dropna().unique().difference(column.cat.categories)
+        if len(categories) > 0:
+            df[df.columns[col]] = column.cat.add_categories(categories)
+    df.iloc[rows, col] = values
+
+# Writes a single value to a dataframe, adding new values to the categories of categorical columns
+def set_value(df: pd.DataFrame, row: int, col: int, value) -> None:
+    column = df.iloc[:, col]
+    if isinstance(column.dtype, pd.CategoricalDtype) and not pd.isna(value) and value not in column.cat.categories:
+        df[df.columns[col]] = column.cat.add_categories([value])
+    df.iat[row, col] = value
+
+# Reports the completed percentage of a task to a callback, calling it only when the percentage increases
+# A task is split into stages that each cover a percentage range and count their own items
+class ProgressReporter():
+    def __init__(self, callback: Callable[[int], None]=None) -> None:
+        self.callback = callback
+        self.percent = -1
+        self.start_stage(1)
+
+    # Starts a stage with total items covering the start to end percentage range
+    def start_stage(self, total: int, start: int=0, end: int=100) -> None:
+        self.total = max(total, 1)
+        self.start = start
+        self.end = end
+        self.next_count = 0 if self.callback else float('inf')
+        self.update(0)
+
+    # Reports the number of completed items in the current stage, cheap enough to call for every item
+    def update(self, count: int) -> None:
+        if count < self.next_count:
+            return
+        percent = self.start + (self.end - self.start) * min(count, self.total) // self.total
+        if percent > self.percent:
+            self.percent = percent
+            self.callback(percent)
+        # Items needed for the next percentage point in this stage
+        span = max(self.end - self.start, 1)
+        self.next_count = -(-(percent + 1 - self.start) * self.total // span)
+
+    def finish(self) -> None:
+        if self.callback and self.percent < 100:
+            self.percent = 100
+            self.callback(100)
+
+# Converters accept an optional progress callback that receives the completed percentage
 class Converter(ABC):
     @abstractmethod
-    def deserialize(self, path: str) -> pd.DataFrame:
+    def deserialize(self, path: str, progress: Callable[[int], None]=None) -> pd.DataFrame:
         pass
 
     @abstractmethod
-    def serialize(self, path: str, df: pd.DataFrame=None) -> None:
+    def serialize(self, path: str, df: pd.DataFrame=None, progress: Callable[[int], None]=None) -> None:
         pass
 
 # Creates state table from csv files and exports state tables to csv
+# Files are read in chunks with explicit column types, with the pyarrow csv reader when pyarrow is installed, and
+# each chunk is converted to the schema types before the next one is read, so the text of the whole file is never
+# held at once. Categorical chunks are combined with union_categoricals. Files are written in batches without the
+# dataframe index.
 class CSVConverter(Converter):
-    def deserialize(self, path: str) -> pd.DataFrame:
+    CHUNK_ROWS = 100000
+    # Path is rebuilt from Parent and Name, codes are read as floats since edited files can have 5.0 codes
+    # and the flags as text so to_boolean accepts every spelling
+    READ_COLUMNS = [c for c in columns if c != 'Path']
+    DTYPES = {c: 'category' if schema[c] == 'category' else 'float64' if schema[c] == 'Int64' else object for c in READ_COLUMNS}
+
+    @instrumented('csv.deserialize')
+    def deserialize(self, path: str, progress: Callable[[int], None]=None) -> pd.DataFrame:
+        reporter = ProgressReporter(progress)
         try:
-            df = pd.read_csv(path, usecols=columns)
-            df = self._prep_df(df)
+            with open(path, 'rb') as file, span('csv.read') as current:
+                reporter.start_stage(os.fstat(file.fileno()).st_size, 0, 90)
+                chunks = []
+                for chunk in self._read_chunks(file):
+                    chunks.append(self._prep_chunk(chunk))
+                    reporter.update(file.tell())
+                current.rows = sum([c.shape[0] for c in chunks])
+            df = self._sort(self._combine(chunks))
         except:
             raise Exception('Error reading file')
     
+        reporter.finish()
         return df
 
-    def serialize(self, path: str, df: pd.DataFrame=None) -> None:
-        df.to_csv(path)
+    # Writes the header and then the rows in batches of CHUNK_ROWS
+    @instrumented('csv.serialize')
+    def serialize(self, path: str, df: pd.DataFrame=None, progress: Callable[[int], None]=None) -> None:
+        reporter = ProgressReporter(progress)
+        reporter.start_stage(df.shape[0])
+        with open(path, 'w', encoding='utf-8', newline='') as file:
+            df.iloc[:0].to_csv(file, index=False)
+            for start in range(0, df.shape[0], self.CHUNK_ROWS):
+                df.iloc[start:start + self.CHUNK_ROWS].to_csv(file, header=False, index=False)
+                reporter.update(start + self.CHUNK_ROWS)
+        reporter.finish()
 
-    def _prep_df(self, df: pd.DataFrame) -> pd.DataFrame:
-        df.drop('Path', axis=1, inplace= True)
-        df['Path'] = df['Parent'] + '/'+ df['Name']
-        df.sort_values('Path', inplace=True)
+    # Returns the file's rows as dataframes of the read columns
+    def _read_chunks(self, file):
+        if importlib.util.find_spec('pyarrow'):
+            yield from self._read_arrow_chunks(file)
+        else:
+            yield from pd.read_csv(file, usecols=self.READ_COLUMNS, dtype=self.DTYPES, chunksize=self.CHUNK_ROWS)
+
+    # Helper function that streams the file with the pyarrow csv reader, categorical columns are dictionary encoded
+    def _read_arrow_chunks(self, file):
+        import pyarrow as pa
+        from pyarrow import csv
+
+        types = {
+            'category': pa.dictionary(pa.int32(), pa.string()),
+            'float64': pa.float64(),
+            object: pa.string(),
+        }
+        reader = csv.open_csv(
+            file,
+            read_options=csv.ReadOptions(block_size=8 << 20),
+            convert_options=csv.ConvertOptions(
+                column_types={c: types[dtype] for c, dtype in self.DTYPES.items()},
+                include_columns=self.READ_COLUMNS,
+                strings_can_be_null=True,
+            ),
+        )
+        # Missing text is NaN like in the pandas reader instead of None
+        text_columns = [c for c, dtype in self.DTYPES.items() if dtype is object]
+        for batch in reader:
+            df = batch.to_pandas()
+            for column in text_columns:
+                df[column] = df[column].where(df[column].notna(), np.nan)
+            yield df
+
+    # Builds the Path column from Parent and Name, adds the Error column and applies the schema to a chunk of rows
+    @staticmethod
+    def _prep_chunk(df: pd.DataFrame) -> pd.DataFrame:
+        df = df.drop(columns=['Path'], errors='ignore')
+        df['Path'] = df['Parent'].astype(object) + '/' + df['Name']
         df['Error'] = ''
+        return apply_schema(df.reindex(columns=columns + ['Error']))
+
+    # Helper function that joins the chunks into one dataframe, the categories of each column are merged
+    @staticmethod
+    def _combine(chunks: list) -> pd.DataFrame:
+        if len(chunks) == 1:
+            return chunks[0].reset_index(drop=True)
+
+        data = {}
+        for column in chunks[0].columns:
+            values = [c[column] for c in chunks]
+            if isinstance(values[0].dtype, pd.CategoricalDtype):
+                data[column] = union_categoricals(values)
+            else:
+                data[column] = pd.concat(values, ignore_index=True).array
+        return pd.DataFrame(data)
+
+    # Sorts the rows by path unless they already are, files written by the tool are sorted
+    @staticmethod
+    def _sort(df: pd.DataFrame) -> pd.DataFrame:
+        if not df['Path'].is_monotonic_increasing:
+            df.sort_values('Path', inplace=True)
         return df
 
+    # Rebuilds the paths of an edited table, sorts the rows and applies the schema, used by the excel converter
+    @staticmethod
+    @instrumented('csv.prepare')
+    def _prep_df(df: pd.DataFrame) -> pd.DataFrame:
+        return CSVConverter._sort(CSVConverter._prep_chunk(df))
+
 # Creates state table from excel file and exports state table to excel
+# Files are read with the calamine engine when python-calamine is installed and with openpyxl otherwise,
+# and written with a write-only openpyxl workbook so memory doesn't grow with the number of rows
 class ExcelConverter(Converter):
-    def deserialize(self, path: str) -> pd.DataFrame:
-        pass
+    SHEET = 'State Table'
+    LISTS_SHEET = 'Lists'
+    # Dropdown values offered for the columns in addition to the values used in the table
+    CHOICES = {
+        'Type': ['Blocked', 'Disabled', 'Idle', 'Planned Downtime', 'Running', 'Starved', 'Unplanned Downtime'],
+        'Scope': ['Detected Equipment State'],
+        'Override': ['Optional'],
+    }
+    # Names, paths and the other text columns are read as strings so cells Excel stores as numbers still join into paths
+    TEXT_DTYPES = {c: str for c in columns if schema[c] in ['object', 'category']}
 
-    def serialize(self, path: str, df: pd.DataFrame=None) -> None:
-        df.to_excel(path)
+    @instrumented('excel.deserialize')
+    def deserialize(self, path: str, progress: Callable[[int], None]=None) -> pd.DataFrame:
+        reporter = ProgressReporter(progress)
+        try:
+            with span('excel.read') as current:
+                df = pd.read_excel(path, sheet_name=0, usecols=columns, dtype=self.TEXT_DTYPES, engine=self.reader_engine())
+                current.rows = df.shape[0]
+            reporter.start_stage(1, 80)
+            df = CSVConverter._prep_df(df)
+        except:
+            raise Exception('Error reading file')
+
+        reporter.finish()
+        return df
+
+    # Returns the fastest installed reader engine
+    @staticmethod
+    def reader_engine() -> str:
+        return 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+
+    @instrumented('excel.serialize')
+    def serialize(self, path: str, df: pd.DataFrame=None, progress: Callable[[int], None]=None) -> None:
+        from openpyxl import Workbook
+        from openpyxl.utils import get_column_letter
+        from openpyxl.worksheet.datavalidation import DataValidation
+
+        reporter = ProgressReporter(progress)
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(self.SHEET)
+        lists = workbook.create_sheet(self.LISTS_SHEET)
+        lists.sheet_state = 'hidden'
+
+        # Each dropdown column gets one validation over all of its rows that reads its values from the hidden sheet,
+        # values that aren't in the list are still accepted
+        choices = []
+        last_row = max(df.shape[0], 1) + 1
+        for column, values in self.CHOICES.items():
+            if column not in df:
+                continue
+            values = list(dict.fromkeys(values + [str(v) for v in df[column].dropna().unique()]))
+            choices.append(values)
+            letter = get_column_letter(len(choices))
+            validation = DataValidation(type='list', formula1=f'={self.LISTS_SHEET}!${letter}$1:${letter}${len(values)}', showErrorMessage=False)
+            col = get_column_letter(df.columns.get_loc(column) + 1)
+            validation.add(f'{col}2:{col}{last_row}')
+            sheet.data_validations.append(validation)
+
+        for row in range(max([len(c) for c in choices], default=0)):
+            lists.append([c[row] if row < len(c) else None for c in choices])
+
+        # Missing values are written as empty cells and the schema types as plain python values
+        sheet.append(df.columns.tolist())
+        values = df.astype(object).where(df.notna(), None)
+        reporter.start_stage(df.shape[0], 0, 90)
+        for count, row in enumerate(values.itertuples(index=False, name=None), 1):
+            sheet.append(row)
+            reporter.update(count)
+
+        workbook.save(path)
+        reporter.finish()
+
+# Creates state table from parquet files and exports state tables to parquet for archiving and analytics jobs
+# The schema types are kept in the file's pandas metadata so tables load without parsing or conversions,
+# the file is memory mapped while it is read. Requires pyarrow.
+class ParquetConverter(Converter):
+    @instrumented('parquet.deserialize')
+    def deserialize(self, path: str, progress: Callable[[int], None]=None) -> pd.DataFrame:
+        reporter = ProgressReporter(progress)
+        try:
+            df = pd.read_parquet(path, engine='pyarrow', columns=columns, memory_map=True)
+            df['Error'] = ''
+            df = apply_schema(df)
+        except:
+            raise Exception('Error reading file')
+
+        reporter.finish()
+        return df
+
+    # The index isn't written, rows are read back in the same order
+    @instrumented('parquet.serialize')
+    def serialize(self, path: str, df: pd.DataFrame=None, progress: Callable[[int], None]=None) -> None:
+        df.to_parquet(path, engine='pyarrow', index=False)
+        ProgressReporter(progress).finish()
 
 # Creates state table from xml export and exports state table to xml
 class XMLConverter(Converter):
     ROOT_CHAR = '~'
+    STATE_ELEMENTS = ['Name', 'Code', 'Type', 'ShortStopThreshold', 'EnableMeantimeMetrics', 'OverrideCurrentLineDowntime', 'Override', 'Scope']
 
     # Reads a xml file and creates a dataframe from the file
-    def deserialize(self, path: str=None) -> pd.DataFrame:
+    # When stream is True the file is read incrementally with iterparse and no element tree is kept
+    # Parsing is reported as the first half of the progress and the traversal as the second half
+    @instrumented('xml.deserialize')
+    def deserialize(self, path: str=None, progress: Callable[[int], None]=None, stream: bool=False) -> pd.DataFrame:
+        if stream:
+            self.xml_tree = None
+            with span('xml.iterparse') as current:
+                rows = list(self.iter_rows(path, progress))
+                current.rows = len(rows)
+            df = self._create_dataframe(rows)
+            self.progress.finish()
+            return df
+
+        self.progress = ProgressReporter(progress)
+
         try:
-            self.xml_tree = ET.parse(path)
+            self.xml_tree = self._parse(path)
             root = self.xml_tree.getroot()
             self.state_count = len(root.findall('.//EquipmentState'))
         except:
@@ -60,12 +372,138 @@ class XMLConverter(Converter):
         if root.tag != 'EquipmentStateRoot':
             raise Exception(f'Invalid XML root, {root.tag}')
     
-        df = pd.DataFrame()
-        for state_class in root:
-            if state_class.tag != 'EquipmentStateClass':
-                continue
-            df = self._destructure(state_class, df)
+        rows = []
+        self.progress.start_stage(self.state_count + len(root.findall('EquipmentStateClass')), 50)
+        with span('xml.destructure') as current:
+            for state_class in root:
+                if state_class.tag != 'EquipmentStateClass':
+                    continue
+                self._destructure(state_class, rows)
+            current.rows = len(rows)
+
+        df = self._create_dataframe(rows)
+        self.progress.finish()
+        return df
+
+    # Parses a xml file in blocks so the parser progress can be reported by bytes read
+    @instrumented('xml.parse')
+    def _parse(self, path: str) -> ET.ElementTree:
+        parser = ET.XMLParser()
+        with open(path, 'rb') as file:
+            self.progress.start_stage(os.fstat(file.fileno()).st_size, 0, 50)
+            while True:
+                data = file.read(1 << 20)
+                if not data:
+                    break
+                parser.feed(data)
+                self.progress.update(file.tell())
+
+        return ET.ElementTree(parser.close())
 
+    # Streams a xml file with iterparse and yields a row dictionary for each node in preorder
+    # Finished elements are removed from the partial tree so memory is bounded by the nesting depth
+    def iter_rows(self, path: str, progress: Callable[[int], None]=None):
+        self.state_count = 0
+        self.current_count = 0
+        self.progress = ProgressReporter(progress)
+        try:
+            file = open(path, 'rb')
+        except:
+            raise Exception('Invalid export file path')
+
+        with file:
+            self.progress.start_stage(os.fstat(file.fileno()).st_size)
+            yield from self._iter_rows(file)
+
+    # Helper function that streams the rows of an open xml file, reporting progress by bytes read
+    def _iter_rows(self, file):
+        try:
+            context = ET.iterparse(file, events=('start', 'end'))
+            _, root = next(context)
+        except:
+            raise Exception('Invalid export file path')
+
+        if root.tag != 'EquipmentStateRoot':
+            raise Exception(f'Invalid XML root, {root.tag}')
+
+        # Each open element is tracked as [element, kind, node] where kind is one of root, node,
+        # pending (a leaf property or a nested node), roles or skip and node is the owning node's
+        # [row_data, parent, state_class, emitted] entry
+        open_elements = [[root, 'root', None]]
+        finished_roles = None
+        try:
+            for event, elem in context:
+                # Roles are flattened one event late so their tail text is included like in the full tree
+                if finished_roles:
+                    roles, roles_parent, node = finished_roles
+                    node[0]['Roles'] = self._roles_to_string(roles) if len(roles) else (roles.text if roles.text else '')
+                    roles.clear()
+                    roles_parent.remove(roles)
+                    finished_roles = None
+
+                if event == 'start':
+                    parent_elem, parent_kind, parent_node = open_elements[-1]
+                    if parent_kind == 'pending':
+                        # A property element with children is a nested node
+                        owner = open_elements[-2][2]
+                        yield from self._emit_row(owner)
+                        parent_node = [{'NodeType': parent_elem.tag}, owner[0]['Path'], owner[2], False]
+                        open_elements[-1][1:] = ['node', parent_node]
+                        parent_kind = 'node'
+                        if parent_elem.tag == 'EquipmentState':
+                            self.state_count += 1
+
+                    if parent_kind == 'root':
+                        if elem.tag == 'EquipmentStateClass':
+                            open_elements.append([elem, 'node', [{'NodeType': elem.tag}, self.ROOT_CHAR, '', False]])
+                        else:
+                            open_elements.append([elem, 'skip', None])
+                    elif parent_kind == 'node':
+                        kind = 'roles' if elem.tag == 'Roles' else 'pending'
+                        open_elements.append([elem, kind, parent_node])
+                    else:
+                        open_elements.append([elem, parent_kind, parent_node])
+                    continue
+
+                _, kind, node = open_elements.pop()
+                parent_elem, parent_kind, _ = open_elements[-1] if open_elements else (None, None, None)
+                if parent_kind not in ['root', 'node']:
+                    # Descendants of roles and skipped elements are released with their outermost element
+                    continue
+
+                if kind == 'roles':
+                    finished_roles = (elem, parent_elem, node)
+                    continue
+
+                if kind == 'node':
+                    yield from self._emit_row(node)
+                    if self.current_count & 255 == 0:
+                        self.progress.update(file.tell())
+                elif kind == 'pending':
+                    node[0][elem.tag] = elem.text if elem.text else ''
+                elem.clear()
+                parent_elem.remove(elem)
+        except ET.ParseError:
+            raise Exception('Invalid export file path')
+
+    # Helper function that completes a streamed node's row dictionary and yields it once
+    def _emit_row(self, node: list):
+        row_data, parent, state_class, emitted = node
+        if emitted:
+            return
+        node[3] = True
+        row_data['StateClass'] = state_class
+        if row_data['NodeType'] == 'EquipmentStateClass':
+            node[2] = row_data['Name']
+        row_data['Parent'] = parent
+        row_data['Path'] = parent + '/' + row_data['Name']
+        self.current_count += 1
+        yield row_data
+
+    # Creates the state table dataframe from the node rows and orders the columns and rows
+    @instrumented('xml.dataframe')
+    def _create_dataframe(self, rows: list) -> pd.DataFrame:
+        df = pd.DataFrame(rows)
         state_class = df.pop('StateClass')
         roles = df.pop('Roles')
         parents = df.pop('Parent')
@@ -78,102 +516,230 @@ class XMLConverter(Converter):
         df.insert(1, 'StateClass', state_class)
         df.sort_values('Path', inplace=True)
 
-        return df.reset_index(drop=True)
+        return apply_schema(df.reset_index(drop=True))
     
     # Creates the etree and writes the XML file
-    def serialize(self, path: str, df: pd.DataFrame=None) -> ET.ElementTree:
+    # When stream is True the document is written incrementally without building an etree and None is returned
+    # tree is the table's hierarchy index, it is built from the Path and Parent columns when not given
+    @instrumented('xml.serialize')
+    def serialize(self, path: str, df: pd.DataFrame=None, progress: Callable[[int], None]=None, stream: bool=False, tree: StateTree=None) -> ET.ElementTree:
         # xml_header = '<?xml version="1.0" encoding="UTF-8" standalone="no"?><EquipmentStateRoot></EquipmentStateRoot>'
         if type(df) != pd.DataFrame:
             df = self.df
+        self.progress = ProgressReporter(progress)
+
+        if tree is None:
+            with span('tree.index', rows=df.shape[0]):
+                tree = StateTree(df['Parent'].tolist(), df['Name'].tolist(), self.ROOT_CHAR)
+
+        if stream:
+            self._write_stream(df, path, tree)
+            self.progress.finish()
+            return None
+
         root = ET.Element('EquipmentStateRoot')
         doc = ET.ElementTree(root)
         
-        index = self._create_tree(0, df, self.ROOT_CHAR, root)
-        if index < df.shape[0]:
-            raise Exception(f'Error Creating node at index {index}')
+        self.progress.start_stage(df.shape[0], 0, 80)
+        self._create_tree(df, root, tree)
         
-        ET.indent(root)
-        # ET.dump(root)
-        doc.write(path)
+        with span('xml.write', rows=df.shape[0]):
+            ET.indent(root)
+            # ET.dump(root)
+            doc.write(path)
+        self.progress.finish()
         return doc
 
     # Helper function that creates a state node with all the state properties
-    def _create_state(self, parent: ET.Element, values: pd.DataFrame) -> ET.Element:
-        elements = ['Name', 'Code', 'Type', 'ShortStopThreshold', 'EnableMeantimeMetrics', 'OverrideCurrentLineDowntime', 'Override', 'Scope']
-        state = ET.SubElement(parent, 'EquipmentState')
+    def _create_state(self, values: dict, index: int) -> ET.Element:
+        state = ET.Element('EquipmentState')
 
-        for e in elements:
+        for e in self.STATE_ELEMENTS:
             temp = ET.SubElement(state, e)
-            value = values[e]
-            if type(values[e]) == np.float64:
-                value = int(value)
-            
-            temp.text = str(value)
+            temp.text = values[e][index]
 
         return state
 
     # Helper function that creates a state class node with all of the state class properties
-    def _create_state_class(self, parent: ET.Element, values: pd.DataFrame) -> ET.Element:
-        state_class = ET.SubElement(parent, 'EquipmentStateClass')
+    def _create_state_class(self, values: dict, index: int) -> ET.Element:
+        state_class = ET.Element('EquipmentStateClass')
         tag = 'Name'
         name = ET.SubElement(state_class, tag)
-        name.text = str(values[tag])
+        name.text = values[tag][index]
 
         tag = 'OverrideCurrentLineDowntime'
         override = ET.SubElement(state_class, tag)
-        override.text = str(values[tag])
+        override.text = values[tag][index]
 
-        tag = 'Roles'
-        if pd.isnull(values['Roles']):
+        roles = values['Roles'][index]
+        if pd.isnull(roles) or roles == '':
             ET.SubElement(state_class, 'Roles')
         else:
-            roles = ET.fromstring(values['Roles'])
-            state_class.append(roles)
+            state_class.append(ET.fromstring(roles))
         
         return state_class
 
-    # Recursively reconstructs the etree from a state table dataframe
-    def _create_tree(self, index: int, df: pd.DataFrame, path: str, parent: ET.Element) -> int:
-        while index < df.shape[0]:
-            if df.loc[index, 'Parent'] != path:
-                break
-            node = None
-            if df.loc[index, 'NodeType'] == 'EquipmentStateClass':
-                node = self._create_state_class(parent,df.iloc[index, :])
+    # Reconstructs the etree from a state table dataframe
+    # Every node is created first and then attached to its parent from the tree index,
+    # so rows can be in any order as long as each parent path exists
+    @instrumented('xml.build_tree')
+    def _create_tree(self, df: pd.DataFrame, root: ET.Element, tree: StateTree) -> None:
+        node_types = df['NodeType'].tolist()
+        values = self._node_values(df)
 
-            if df.loc[index, 'NodeType'] == 'EquipmentState':
-                node = self._create_state(parent, df.iloc[index, :])
+        elements = []
+        for index, node_type in enumerate(node_types):
+            if node_type == 'EquipmentStateClass':
+                node = self._create_state_class(values, index)
+            elif node_type == 'EquipmentState':
+                node = self._create_state(values, index)
+            else:
+                raise Exception(f'Error Creating node at index {index}, invalid node type {node_type}')
+            elements.append(node)
+            self.progress.update(index)
 
-            index = self._create_tree(index + 1, df, df.loc[index, 'Path'], node)
+        self._check_parents(df, tree)
+        elements.append(root)
+        for index, parent in enumerate(tree.parent_ids[:-1].tolist()):
+            elements[parent].append(elements[index])
 
-        return index    
-    
-    # Performs a recursive preorder depth first traversal of the export file, adding each nodes to a state table dataframe
-    def _destructure(self, node: ET.ElementTree, df: pd.DataFrame, parent: str=ROOT_CHAR, state_class: str='') -> pd.DataFrame:
-        deep_children = []
-        row_data = {}
-        row_data['NodeType'] = node.tag
-        
-        for child in node:
-            if len(child) == 0:
-                row_data[child.tag] = child.text if child.text else ''
-            elif child.tag == 'Roles':
-                row_data[child.tag] = ET.tostring(child).decode('ascii').replace(' ', '').replace('\n','')
+    # Helper function that raises an exception for the first row whose parent path doesn't exist
+    def _check_parents(self, df: pd.DataFrame, tree: StateTree) -> None:
+        orphans = tree.orphans()
+        if orphans:
+            index = orphans[0]
+            raise Exception(f'Error Creating node at index {index}, missing parent {df["Parent"].iat[index]}')
+
+    # Writes the XML file node by node in preorder, producing the same indented output as serialize
+    # The rows are validated before the file is opened so an invalid table doesn't leave a partial file
+    @instrumented('xml.write_stream')
+    def _write_stream(self, df: pd.DataFrame, path: str, tree: StateTree) -> None:
+        node_types = df['NodeType'].tolist()
+        values = self._node_values(df)
+
+        for index, node_type in enumerate(node_types):
+            if node_type not in ['EquipmentStateClass', 'EquipmentState']:
+                raise Exception(f'Error Creating node at index {index}, invalid node type {node_type}')
+        self._check_parents(df, tree)
+
+        root = tree.root
+        children = tree.children
+        indents = ['\n']
+        with open(path, 'w', encoding='us-ascii', errors='xmlcharrefreplace') as file:
+            if not children[root]:
+                file.write('<EquipmentStateRoot />')
+                return
+
+            parts = ['<EquipmentStateRoot>']
+            written = 0
+            self.progress.start_stage(root)
+            stack = [(iter(children[root]), 0, 'EquipmentStateRoot')]
+            while stack:
+                siblings, level, tag = stack[-1]
+                index = next(siblings, None)
+                if index is None:
+                    stack.pop()
+                    parts.append(f'{indents[level]}</{tag}>')
+                    continue
+
+                level += 1
+                while len(indents) <= level + 1:
+                    indents.append(indents[-1] + '  ')
+                tag = node_types[index]
+                parts.append(f'{indents[level]}<{tag}>')
+                self._write_node_values(parts, values, index, tag, level + 1, indents[level + 1])
+                stack.append((iter(children[index]), level, tag))
+                written += 1
+                self.progress.update(written)
+
+                if len(parts) > 10000:
+                    file.write(''.join(parts))
+                    parts = []
+
+            file.write(''.join(parts))
+
+    # Helper function that appends the indented property elements of a node to the output parts
+    def _write_node_values(self, parts: list, values: dict, index: int, node_type: str, level: int, indent: str) -> None:
+        tags = self.STATE_ELEMENTS if node_type == 'EquipmentState' else ['Name', 'OverrideCurrentLineDowntime']
+        for tag in tags:
+            text = values[tag][index]
+            if text:
+                parts.append(f'{indent}<{tag}>{self._escape(text)}</{tag}>')
             else:
-                deep_children.append(child)
-        row_data['StateClass'] = state_class
-        if node.tag == 'EquipmentStateClass':
-            state_class = row_data['Name']
-        row_data['Parent'] = parent
-        row_data['Path'] = parent + '/' + row_data['Name']
-        row = pd.DataFrame([row_data])
-        df = pd.concat([df, row])
-        self._processed_count(df.shape[0])
-        for child in deep_children:  
-            df = self._destructure(child, df, f'{parent}/{row_data["Name"]}', state_class)
+                parts.append(f'{indent}<{tag} />')
 
-        return df
+        if node_type == 'EquipmentState':
+            return
+
+        roles = values['Roles'][index]
+        if pd.isnull(roles) or roles == '':
+            parts.append(f'{indent}<Roles />')
+            return
+        roles = ET.fromstring(roles)
+        ET.indent(roles, level=level)
+        parts.append(indent + ET.tostring(roles, encoding='unicode'))
+
+    # Helper function that escapes element text the same way ElementTree does
+    def _escape(self, text: str) -> str:
+        if '&' in text:
+            text = text.replace('&', '&amp;')
+        if '<' in text:
+            text = text.replace('<', '&lt;')
+        if '>' in text:
+            text = text.replace('>', '&gt;')
+        return text
+
+    # Helper function that converts the columns used by the XML nodes to lists of element text values
+    def _node_values(self, df: pd.DataFrame) -> dict:
+        values = {e: self._column_text(df[e]) for e in self.STATE_ELEMENTS}
+        values['Roles'] = df['Roles'].tolist()
+        return values
+
+    # Helper function that converts a column to a list of element text values
+    # Flags are written as true or false and missing values as empty text
+    def _column_text(self, column: pd.Series) -> list:
+        if pd.api.types.is_bool_dtype(column):
+            text = boolean_text(column)
+        else:
+            text = column.astype(str)
+        text[column.isna()] = ''
+        return text.tolist()
+    
+    # Performs an iterative preorder depth first traversal of the export file, appending a row dictionary for each node to rows
+    def _destructure(self, node: ET.Element, rows: list, parent: str=ROOT_CHAR, state_class: str='') -> list:
+        stack = [(node, parent, state_class)]
+        while stack:
+            node, parent, state_class = stack.pop()
+            deep_children = []
+            row_data = {}
+            row_data['NodeType'] = node.tag
+
+            for child in node:
+                if len(child) == 0:
+                    row_data[child.tag] = child.text if child.text else ''
+                elif child.tag == 'Roles':
+                    row_data[child.tag] = self._roles_to_string(child)
+                else:
+                    deep_children.append(child)
+            row_data['StateClass'] = state_class
+            if node.tag == 'EquipmentStateClass':
+                state_class = row_data['Name']
+            row_data['Parent'] = parent
+            row_data['Path'] = parent + '/' + row_data['Name']
+            rows.append(row_data)
+            self._processed_count(len(rows))
+
+            # Children are pushed in reverse so they are popped in document order
+            for child in reversed(deep_children):
+                stack.append((child, row_data['Path'], state_class))
+
+        return rows
+
+    # Helper function that flattens a roles element into a compact xml string
+    def _roles_to_string(self, roles: ET.Element) -> str:
+        return ET.tostring(roles).decode('ascii').replace(' ', '').replace('\n','')
 
     # Updates the current number of nodes processed 
     def _processed_count(self, value: int) -> None:
-        self.current_count = value
\ No newline at end of file
+        self.current_count = value
+        self.progress.update(value)
\ No newline at end of file
@@ -0,0 +1,160 @@
+import functools
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+# Timing of the named stages of opening, checking and writing state tables
+# Stages are wrapped in spans that record their wall time, row count and, when memory tracing is on, the peak
+# memory allocated while they ran. Spans nest per thread so a stage's time includes its sub stages.
+# While recording is off span() returns a shared no-op span, so the instrumented code only pays for one check.
+# Memory is traced process wide with tracemalloc, which slows the traced code down, and the peaks of spans
+# running on different threads at the same time include each other's allocations.
+class Instrumentation():
+    def __init__(self) -> None:
+        self.enabled = False
+        self.trace_memory = False
+        self.spans = []
+        self._started_tracing = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.perf_counter()
+
+    # Starts recording spans, memory tracing is only started when asked for since it slows everything down
+    def enable(self, trace_memory: bool=False) -> None:
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.trace_memory = trace_memory
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+        self.trace_memory = False
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans = []
+            self._start = time.perf_counter()
+
+    # Returns a context manager timing the named stage, rows can also be set on it once they are known
+    def span(self, name: str, rows: int=None):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, rows)
+
+    # Returns the recorded spans as dictionaries in start order, parent is the index of the enclosing span
+    def to_list(self) -> list:
+        with self._lock:
+            return [dict(record) for record in self.spans]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.to_list(), columns=Span.FIELDS)
+        return df.astype({'parent': 'Int64', 'depth': 'Int64', 'rows': 'Int64', 'seconds': float, 'peak_mb': float})
+
+    # Returns the total time, calls and rows of each stage, slowest first
+    def summary(self) -> pd.DataFrame:
+        df = self.to_dataframe()
+        summary = df.groupby('name', sort=False).agg(calls=('name', 'size'), seconds=('seconds', 'sum'), rows=('rows', 'sum'), peak_mb=('peak_mb', 'max'))
+        return summary.sort_values('seconds', ascending=False).reset_index()
+
+    # Helper function that returns the open spans of the current thread
+    def _stack(self) -> list:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    # Helper function that stores a started span and returns its index
+    def _add(self, record: dict) -> int:
+        with self._lock:
+            self.spans.append(record)
+            return len(self.spans) - 1
+
+class Span():
+    FIELDS = ['name', 'parent', 'depth', 'thread', 'start', 'seconds', 'rows', 'peak_mb']
+
+    def __init__(self, instrumentation: Instrumentation, name: str, rows: int=None) -> None:
+        self.instrumentation = instrumentation
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self) -> 'Span':
+        instrumentation = self.instrumentation
+        stack = instrumentation._stack()
+        parent = stack[-1] if stack else None
+
+        # The traced peak is reset for each span, the running peak of the enclosing span is kept on it first
+        self.tracing = instrumentation.trace_memory and tracemalloc.is_tracing()
+        self.peak = 0
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent.peak = max(parent.peak, peak)
+            tracemalloc.reset_peak()
+            self.memory = current
+
+        self.record = {
+            'name': self.name,
+            'parent': parent.index if parent is not None else None,
+            'depth': len(stack),
+            'thread': threading.current_thread().name,
+            'start': round(time.perf_counter() - instrumentation._start, 6),
+            'seconds': None,
+            'rows': None,
+            'peak_mb': None,
+        }
+        self.index = instrumentation._add(self.record)
+        stack.append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.record['seconds'] = round(time.perf_counter() - self.started, 6)
+        self.record['rows'] = self.rows
+        stack = self.instrumentation._stack()
+        stack.pop()
+        if self.tracing and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.peak)
+            self.record['peak_mb'] = round((peak - self.memory) / 2**20, 3)
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+
+# Stands in for every span while recording is off
+class NullSpan():
+    rows = None
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def __setattr__(self, name: str, value) -> None:
+        pass
+
+NULL_SPAN = NullSpan()
+
+instrumentation = Instrumentation()
+
+def span(name: str, rows: int=None):
+    return instrumentation.span(name, rows)
+
+# Decorator that wraps a function in a span, the rows are taken from a returned dataframe or else
+# from the first dataframe argument
+def instrumented(name: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not instrumentation.enabled:
+                return function(*args, **kwargs)
+            with Span(instrumentation, name) as current:
+                result = function(*args, **kwargs)
+                frames = [result] + list(args) + list(kwargs.values())
+                current.rows = next((f.shape[0] for f in frames if isinstance(f, pd.DataFrame)), None)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from state_table import StateTable, StateTableErrors
+
+# On disk cache of opened and validated state tables
+# Entries are keyed by the file's absolute path, size and modification time (or a hash of its content),
+# so an edited file never matches its old entry. The least recently used entries are removed once
+# the cache grows past its size limit.
+class ParseCache():
+    VERSION = 3
+    EXTENSION = '.pkl'
+
+    def __init__(self, directory: str=None, max_bytes: int=512 * 1024 * 1024, content_hash: bool=False) -> None:
+        self.directory = directory or self.default_directory()
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        os.makedirs(self.directory, exist_ok=True)
+
+    # Returns the per user cache directory
+    @staticmethod
+    def default_directory() -> str:
+        base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'state_export_import_tool')
+
+    # Returns the cache key for a file, variant separates entries created with different checker options
+    def key(self, path: str, variant: str='') -> str:
+        stat = os.stat(path)
+        key = hashlib.sha1(f'{self.VERSION}|{os.path.abspath(path)}|{variant}'.encode())
+        if self.content_hash:
+            with open(path, 'rb') as file:
+                key.update(hashlib.file_digest(file, 'sha1').digest())
+        else:
+            key.update(f'|{stat.st_size}|{stat.st_mtime_ns}'.encode())
+        return key.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.EXTENSION)
+
+    # Returns the cached state table for an unchanged file or None
+    # A missing, unreadable or outdated entry is treated as a cache miss
+    def load(self, path: str, variant: str='') -> StateTable:
+        try:
+            entry_path = self.entry_path(self.key(path, variant))
+            with open(entry_path, 'rb') as file:
+                entry = pickle.load(file)
+            if entry['version'] != self.VERSION:
+                return None
+            os.utime(entry_path)
+        except Exception:
+            return None
+
+        # A cache hit means the export is unchanged, so it can still be copied by to_xml
+        xml_source = None
+        if path.lower().endswith('.xml'):
+            stat = os.stat(path)
+            xml_source = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        state_table = StateTable(entry['df'], xml_source=xml_source)
+        errors = StateTableErrors(checked=True)
+        errors.rows, errors.codes, errors.messages = entry['errors']
+        state_table.errors = errors
+        return state_table
+
+    # Stores a validated state table for a file and trims the cache to its size limit
+    # Entries are written to a temporary file first so readers never see a partial entry
+    def store(self, path: str, state_table: StateTable, variant: str='') -> None:
+        errors = state_table.errors
+        entry = {
+            'version': self.VERSION,
+            'df': state_table.to_dataframe(),
+            'errors': (errors.rows, errors.codes, errors.messages),
+        }
+        temp_path = None
+        try:
+            entry_path = self.entry_path(self.key(path, variant))
+            handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(handle, 'wb') as file:
+                pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, entry_path)
+        except Exception:
+            # evict only counts finished entries, so a failed write removes its temporary file here
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self.evict()
+
+    # Removes the least recently used entries until the cache fits in its size limit
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.EXTENSION):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum([e[1] for e in entries])
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    # Removes every entry from the cache
+    def clear(self) -> None:
+        for name in os.listdir(self.directory):
+            if name.endswith(self.EXTENSION):
+                os.remove(os.path.join(self.directory, name))
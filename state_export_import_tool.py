@@ -1,11 +1,20 @@
+import os
 import sys
-from PySide6.QtCore import (QDir, Qt, QTimer, Slot)
+from datetime import datetime
+from PySide6.QtCore import (QDir, Qt, QThreadPool, Slot)
 from PySide6.QtWidgets import (QAbstractItemView, QApplication, QFileDialog, QGridLayout, QHeaderView, QLabel, QPushButton, QProgressBar, QTableWidget, QTableWidgetItem, QWidget)
-from state_table import StateTable, StateTableChecker
-from state_table_widget import StateTableWidget
+from parse_cache import ParseCache
+from state_table import StateTableChecker
+from state_table_widget import DiagnosticsWidget, StateTableDiffWidget, StateTableWidget
 from utils import template
+from workers import ExportWorker, OpenFileWorker
 # from time import strftime
 
+# Fields of the output name templates, unknown fields are left as they are
+class OutputNameFields(dict):
+    def __missing__(self, key):
+        return '{' + key + '}'
+
 class StateExportImportTool(QWidget):
     def __init__(self, data=[]):
         super().__init__()
@@ -19,57 +28,83 @@ class StateExportImportTool(QWidget):
         self.button.clicked.connect(self.open_Files)
         self.template_button = QPushButton('Download CSV Template')
         self.template_button.clicked.connect(self.download_template_button_clicked)
+        self.compare_button = QPushButton('Compare Selected')
+        self.compare_button.setDisabled(True)
+        self.compare_button.clicked.connect(self.compare_button_clicked)
 
         # Create and connect signals for the conversion and state table preview buttons
         self.preview_button = QPushButton('Preview State Table')
         self.preview_button.setDisabled(True)
         self.preview_button.clicked.connect(self.preview)
-        self.xml_to_excel_button = QPushButton('XML -> CSV')
+        self.xml_to_excel_button = QPushButton('XML -> CSV/Excel')
         self.xml_to_excel_button.setDisabled(True)
         self.xml_to_excel_button.clicked.connect(self.to_csv_button_clicked)
-        self.excel_to_xml_button = QPushButton('CSV -> XML')
+        self.excel_to_xml_button = QPushButton('CSV/Excel -> XML')
         self.excel_to_xml_button.setDisabled(True)
         self.excel_to_xml_button.clicked.connect(self.to_xml_button_clicked)
         self.progress_label = QLabel('Select files to convert!')
+        self.diagnostics_button = QPushButton('Diagnostics')
+        self.diagnostics_button.clicked.connect(self.diagnostics_button_clicked)
+        self.cancel_button = QPushButton('Cancel Export')
+        self.cancel_button.clicked.connect(self.cancel_exports)
+        self.cancel_button.hide()
         # self.progress_label.hide()
 
         # Creates the table that holds the open files details
         self.table = self.create_table()
-        # self.progress_bar = self.create_progress_bar()
-        # self.progress_bar.hide()
+        self.progress_bar = self.create_progress_bar()
+        self.progress_bar.hide()
 
         # Adds the UI widgets to the main widget container and sets the widget positions in the grid layout
         self.layout.addWidget(self.button, 0, 0, 1, 3)
+        self.layout.addWidget(self.compare_button, 0, 4, 1, 3)
         self.layout.addWidget(self.template_button, 0, 8, 1, 4)
         self.layout.addWidget(self.table, 1, 0, 1, 12)
         self.layout.addWidget(self.preview_button, 2, 0, 1, 4)
         self.layout.addWidget(self.xml_to_excel_button, 2, 5, 1, 3)
         self.layout.addWidget(self.excel_to_xml_button, 2, 9, 1, 3)
-        self.layout.addWidget(self.progress_label, 3, 0, 1, 12)
-        # self.layout.addWidget(self.progress_bar, 4, 0, 1, 12)
+        self.layout.addWidget(self.progress_label, 3, 0, 1, 9)
+        self.layout.addWidget(self.diagnostics_button, 3, 9, 1, 3)
+        self.layout.addWidget(self.progress_bar, 4, 0, 1, 9)
+        self.layout.addWidget(self.cancel_button, 4, 9, 1, 3)
 
         # Creates an instance of the state table validation class
         self.state_tables = []
         self.state_table_checker = StateTableChecker()
+
+        # Files are opened and validated on a thread pool so the window stays responsive
+        # The progress of each opening file is kept by row until the whole batch is done
+        self.thread_pool = QThreadPool(self)
+        self.file_progress = {}
+        self.files_done = 0
+        # Exports are queued on the same pool and tracked by row like the opening files
+        self.export_workers = {}
+        self.export_progress = {}
+        self.exports_done = 0
+        self.parse_cache = ParseCache()
     
     # Enables/disables conversion buttons based on file table row selection checkboxes
     # Conversion buttons are enabled if all the selected rows are the same file type
+    # The compare button is enabled when exactly two rows are selected
     @Slot()
     def cell_changed(self, row, col):
         if col == 0:
             is_csv = False
             is_xml = False
+            checked = 0
             for i in range(self.table.rowCount()):
                 selected = self.table.item(i, 0)
                 if selected.checkState() == Qt.CheckState.Checked:
+                    checked += 1
                     file_extension = self.table.item(i, 1).text().split('.')[-1]
                     if file_extension in ['xml']:
                         is_xml = True
-                    if file_extension in ['csv']:
+                    if file_extension in ['csv', 'xlsx']:
                         is_csv = True
             print(f'is_xml {is_xml}, is_csv {is_csv} test {not (is_xml and not is_csv)}')
             self.xml_to_excel_button.setDisabled(not (is_xml and not is_csv))
             self.excel_to_xml_button.setDisabled(not (is_csv and not is_xml))
+            self.compare_button.setDisabled(checked != 2)
 
     @Slot()
     def cell_clicked(self, row, col):
@@ -88,12 +123,13 @@ class StateExportImportTool(QWidget):
         self.preview_button.setDisabled(False)
 
     # Handles opening the selected files and creating state table instances from the files
+    # A row is added for each file right away and its state table is created and validated on the thread pool
     @Slot()
     def open_Files(self):
         files = QFileDialog.getOpenFileNames(self, 
                                              'Select one or more files to open', 
                                              QDir.currentPath(), 
-                                             'CSV and XML (*.csv *xml);;CSV (*.csv);; XML (*.xml)'
+                                             'State Tables (*.csv *.xlsx *.xml);;CSV (*.csv);;Excel (*.xlsx);; XML (*.xml)'
                                              )
         filenames = files[0]
         files_dict = {f.split('/')[-1]: f for f in filenames}
@@ -106,20 +142,67 @@ class StateExportImportTool(QWidget):
             extension = split_name[-1]
             
             # Create state table from file using the file path
-            # TODO: handle read errors or invalid files
-            state_table = None
-            if extension == 'csv':
-                state_table = StateTable().from_csv(path)
-            elif extension == 'xml':
-                state_table = StateTable().from_xml(path)
-            
-            message = None
-            if state_table:
-                errors = self.state_table_checker.check_for_errors(state_table)
-                if errors:
-                    message = str(errors)
+            message = 'Opening...' if extension in ['csv', 'xlsx', 'xml'] else None
             row_num = self.insert_table_row(filename=filename, path=path, extension=extension, output_name=output_name, message=message)
-            self.state_tables.insert(row_num, state_table)
+            self.state_tables.insert(row_num, None)
+            if message:
+                worker = OpenFileWorker(row_num, path, extension, self.state_table_checker, self.parse_cache)
+                worker.signals.finished.connect(self.file_opened)
+                worker.signals.error.connect(self.file_open_failed)
+                worker.signals.progress.connect(self.file_progress_changed)
+                self.file_progress[row_num] = 0
+                self.thread_pool.start(worker)
+
+        self.update_progress()
+
+    # Stores the state table created by an open file worker and shows its validation summary
+    @Slot(int, object, str)
+    def file_opened(self, row, state_table, message):
+        self.state_tables[row] = state_table
+        self.update_table_row(row, message=message)
+        self.file_finished(row)
+
+    # Shows the error raised while opening a file in the file's row
+    @Slot(int, str)
+    def file_open_failed(self, row, message):
+        self.update_table_row(row, message=f'Error: {message}')
+        self.file_finished(row)
+
+    # Shows the progress of an opening file in its row and updates the overall progress
+    @Slot(int, int)
+    def file_progress_changed(self, row, percent):
+        if row not in self.file_progress:
+            return
+        self.file_progress[row] = percent
+        self.update_table_row(row, message=f'Opening... {percent}%')
+        self.update_progress()
+
+    # Removes a file from the opening files and updates the overall progress
+    def file_finished(self, row):
+        self.file_progress.pop(row, None)
+        self.files_done += 1
+        self.update_progress()
+
+    # Shows the overall progress of the files being opened and exported, hiding the progress bar once every file is done
+    def update_progress(self):
+        if not self.file_progress:
+            self.files_done = 0
+        if not self.export_progress:
+            self.exports_done = 0
+            self.cancel_button.hide()
+
+        tasks = [('Opening', self.file_progress, self.files_done), ('Exporting', self.export_progress, self.exports_done)]
+        tasks = [task for task in tasks if task[1]]
+        if not tasks:
+            self.progress_bar.hide()
+            self.progress_label.setText('Select files to convert!')
+            return
+
+        total = sum([done + len(progress) for _, progress, done in tasks])
+        self.progress_bar.setRange(0, 100 * total)
+        self.progress_bar.setValue(sum([100 * done + sum(progress.values()) for _, progress, done in tasks]))
+        self.progress_bar.show()
+        self.progress_label.setText(', '.join([f'{verb} files, {done} of {done + len(progress)} done' for verb, progress, done in tasks]))
 
     # Opens the state table widget windows for the selected row in the open files table
     @Slot()
@@ -127,17 +210,37 @@ class StateExportImportTool(QWidget):
         print(f'Preview button clicked')
         selected_items = self.table.selectedItems()
         row = self.table.row(selected_items[0])
+        if not self.state_tables[row]:
+            return
 
-        self.state_table_widget = StateTableWidget(self.state_tables[row])
+        state_table = self.state_tables[row]
+        self.state_table_widget = StateTableWidget(state_table)
+        self.state_table_widget.errors_changed.connect(lambda: self.update_table_row(row, message=state_table.errors.summary()))
         self.state_table_widget.resize(900, 600)
         self.state_table_widget.show()
     
-    # TODO: Display deserialization/serialization progress 
+    # Opens a window with the changes from the first to the second selected file
     @Slot()
-    def advance_progressbar(self):
-        cur_val = self.progress_bar.value()
-        max_val = self.progress_bar.maximum()
-        self.progress_bar.setValue(cur_val + (max_val - cur_val) / 100)
+    def compare_button_clicked(self):
+        files = self.get_selected_files()
+        if len(files) != 2:
+            return
+
+        old, new = [self.state_tables[file['row']] for file in files]
+        if not old or not new:
+            self.progress_label.setText('Wait for both files to open before comparing')
+            return
+
+        self.state_table_diff_widget = StateTableDiffWidget(old.diff(new), files[0]['File Name'], files[1]['File Name'])
+        self.state_table_diff_widget.resize(900, 600)
+        self.state_table_diff_widget.show()
+
+    # Opens the window with the recorded timings of opening, checking and writing files
+    @Slot()
+    def diagnostics_button_clicked(self):
+        self.diagnostics_widget = DiagnosticsWidget()
+        self.diagnostics_widget.resize(700, 400)
+        self.diagnostics_widget.show()
 
     # Opens a save file dialog to download a csv state table template
     @Slot()
@@ -150,41 +253,134 @@ class StateExportImportTool(QWidget):
         with open(filename, 'w') as file:
             file.write(template)
 
-    # Opens a save file dialog and generate a csv export of the selected open files
+    # Exports the selected open files to csv or excel files
+    # The export is an excel file when the Excel file type is chosen or the output name ends with .xlsx
     @Slot()
     def to_csv_button_clicked(self):
         print('XML to CSV button pressed')
-        files = self.get_selected_files()
-        
-        for file in files:
-            print(f'file: {file}')
-            state_table = self.state_tables[file['row']]
-
-            filename, _ = QFileDialog().getSaveFileName(self,
-                                            'Save State Table', 
-                                             f'{QDir.currentPath()}/{file['Output Name']}', 
-                                             'CSV (*.csv)'
-                                             )
-            print(filename)
-            state_table.to_csv(filename)
-                
-    # Opens a save file dialog and generate a xml export of the selected open files
+        self.export_files(['csv', 'xlsx'], 'CSV (*.csv);;Excel (*.xlsx)')
+
+    # Exports the selected open files to xml files
     @Slot()
     def to_xml_button_clicked(self):
         print('CSV to XML button pressed')
+        self.export_files(['xml'], 'XML (*.xml)')
+
+    # Asks for the output paths of all the selected files first and then queues the exports on the thread pool
+    # A single file is saved through a save dialog and several files to a picked directory under their output names
+    # extensions are the export's file types, the first one is used for output names without one
+    def export_files(self, extensions: list, file_filter: str):
         files = self.get_selected_files()
-        
-        for file in files:
-            print(f'file: {file}')
-            state_table = self.state_tables[file['row']]
-
-            filename, _ = QFileDialog().getSaveFileName(self,
-                                            'Save State Table', 
-                                             f'{QDir.currentPath()}/{file['Output Name']}', 
-                                             'XML (*.xml)'
+        files = [f for f in files if self.state_tables[f['row']] and f['row'] not in self.export_workers]
+        if not files:
+            return
+
+        now = datetime.now()
+        names = [self.format_output_name(file, now) for file in files]
+        if len(files) == 1:
+            filename, file_type = QFileDialog().getSaveFileName(self,
+                                            'Save State Table',
+                                             f'{QDir.currentPath()}/{names[0]}',
+                                             file_filter
                                              )
-            print(filename)
-            state_table.to_xml(filename)
+            if not filename:
+                return
+            paths = [self.get_output_path(filename, extensions, file_type)]
+        else:
+            directory = QFileDialog.getExistingDirectory(self, 'Save State Tables', QDir.currentPath())
+            if not directory:
+                return
+            # Files with the same output name get a numbered suffix instead of overwriting each other
+            paths = []
+            for name in names:
+                path = self.get_output_path(os.path.join(directory, name), extensions)
+                stem, extension = os.path.splitext(path)
+                count = 1
+                while path in paths:
+                    count += 1
+                    path = f'{stem}_{count}{extension}'
+                paths.append(path)
+
+        for file, path in zip(files, paths):
+            self.start_export(file['row'], path)
+        self.cancel_button.show()
+        self.update_progress()
+
+    # Expands the {name}, {date} and {time} fields of a file's output name, name is the opened file's name
+    # without its extension. An output name that isn't a valid template is used as it is.
+    def format_output_name(self, file: dict, now: datetime) -> str:
+        fields = OutputNameFields(name=os.path.splitext(file['File Name'])[0], date=now.strftime('%Y%m%d'), time=now.strftime('%H%M%S'))
+        try:
+            return file['Output Name'].format_map(fields) or fields['name']
+        except (AttributeError, IndexError, KeyError, ValueError):
+            return file['Output Name']
+
+    # Returns an output path with one of the export's extensions, the Excel file type of the save dialog picks xlsx
+    def get_output_path(self, path: str, extensions: list, file_type: str='') -> str:
+        if file_type.startswith('Excel'):
+            return path if path.lower().endswith('.xlsx') else f'{path}.xlsx'
+        if path.split('.')[-1].lower() in extensions:
+            return path
+        return f'{path}.{extensions[0]}'
+
+    # Queues the export of an open file and shows its status in the file's row
+    def start_export(self, row: int, path: str):
+        worker = ExportWorker(row, self.state_tables[row], path, path.split('.')[-1].lower())
+        worker.setAutoDelete(False)
+        worker.signals.finished.connect(self.file_exported)
+        worker.signals.error.connect(self.file_export_failed)
+        worker.signals.cancelled.connect(self.file_export_cancelled)
+        worker.signals.progress.connect(self.export_progress_changed)
+        self.export_workers[row] = worker
+        self.export_progress[row] = 0
+        self.update_table_row(row, message=self.get_status_message(row, 'Export queued'))
+        self.thread_pool.start(worker)
+
+    # Cancels the queued and running exports, queued exports are taken off the pool right away
+    @Slot()
+    def cancel_exports(self):
+        for worker in list(self.export_workers.values()):
+            worker.cancel()
+            if self.thread_pool.tryTake(worker):
+                self.file_export_cancelled(worker.row)
+
+    @Slot(int, object, str)
+    def file_exported(self, row, state_table, path):
+        self.update_table_row(row, message=self.get_status_message(row, f'Exported {os.path.basename(path)}'))
+        self.export_finished(row)
+
+    @Slot(int, str)
+    def file_export_failed(self, row, message):
+        self.update_table_row(row, message=self.get_status_message(row, f'Export error: {message}'))
+        self.export_finished(row)
+
+    @Slot(int)
+    def file_export_cancelled(self, row):
+        if row not in self.export_workers:
+            return
+        self.update_table_row(row, message=self.get_status_message(row, 'Export cancelled'))
+        self.export_finished(row)
+
+    # Shows the progress of an exporting file in its row and updates the overall progress
+    @Slot(int, int)
+    def export_progress_changed(self, row, percent):
+        if row not in self.export_progress:
+            return
+        self.export_progress[row] = percent
+        self.update_table_row(row, message=self.get_status_message(row, f'Exporting... {percent}%'))
+        self.update_progress()
+
+    # Removes a file from the exporting files and updates the overall progress
+    def export_finished(self, row):
+        self.export_workers.pop(row, None)
+        self.export_progress.pop(row, None)
+        self.exports_done += 1
+        self.update_progress()
+
+    # Returns the row's validation summary followed by an export status
+    def get_status_message(self, row: int, status: str) -> str:
+        summary = self.state_tables[row].errors.summary() if self.state_tables[row].errors else ''
+        return ' | '.join([m for m in [summary, status] if m])
 
     # Iterate through the open files table and return the selected rows data
     def get_selected_files(self):
@@ -245,10 +441,11 @@ class StateExportImportTool(QWidget):
             return row_num
 
     # Updates the data for a given row in the open files table
-    def update_table_row(self, row, *, selected=False, filename=None, path=None, extension=None, output_name=None, message=None):
-        checkbox_item = QTableWidgetItem()
-        checkbox_item.setCheckState(Qt.CheckState.Checked if selected else Qt.CheckState.Unchecked)
-        self.table.setItem(row, 0, checkbox_item)
+    def update_table_row(self, row, *, selected=None, filename=None, path=None, extension=None, output_name=None, message=None):
+        if selected != None:
+            checkbox_item = QTableWidgetItem()
+            checkbox_item.setCheckState(Qt.CheckState.Checked if selected else Qt.CheckState.Unchecked)
+            self.table.setItem(row, 0, checkbox_item)
 
         if filename != None:
             filename_item = QTableWidgetItem(filename)
@@ -274,13 +471,10 @@ class StateExportImportTool(QWidget):
             message_item.setFlags(message_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
             self.table.setItem(row, 5, message_item)
 
-    # Creates a progress bar with test values
+    # Creates the progress bar that shows the overall progress of the files being opened
     def create_progress_bar(self):
         progress_bar = QProgressBar()
-        progress_bar.setRange(0, 10000)
-        timer = QTimer(self)
-        timer.timeout.connect(self.advance_progressbar)
-        timer.start(1000)
+        progress_bar.setRange(0, 100)
         return progress_bar
 
 if __name__ == '__main__':
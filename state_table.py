@@ -1,23 +1,83 @@
+import bisect
+import numpy as np
+import os
 import pandas as pd
-from conversions import CSVConverter, XMLConverter
+import shutil
+import xml.etree.ElementTree as ET
+from conversions import CSVConverter, ExcelConverter, ParquetConverter, ProgressReporter, XMLConverter, apply_schema, columns, set_value, set_values
+from instrumentation import instrumented, span
+from state_tree import PathTrie, StateTree
+from typing import Callable
 
 class StateTable():
     csv_converter = CSVConverter()
-    xml_converter = XMLConverter()
     
-    def __init__(self, df: pd.DataFrame=None) -> None:
+    # xml_tree caches the document of the table and xml_source is the (path, size, mtime) of the export it was
+    # read from, to_xml reuses them until the table is marked dirty
+    def __init__(self, df: pd.DataFrame=None, xml_tree: ET.ElementTree=None, xml_source: tuple=None) -> None:
         self.df = df
+        self.xml_tree = xml_tree
+        self.xml_source = xml_source
+        self.dirty = xml_tree is None and xml_source is None
+        self.errors = StateTableErrors()
+
+    # Replacing the dataframe invalidates the cached xml document
+    @property
+    def df(self) -> pd.DataFrame:
+        return self._df
+
+    @df.setter
+    def df(self, df: pd.DataFrame) -> None:
+        self._df = df
+        self.mark_dirty()
+
+    # Marks the cached xml document and tree index as out of date, must be called after editing the dataframe
+    # The document is dropped since it can't be written any more
+    def mark_dirty(self) -> None:
+        self.dirty = True
         self.xml_tree = None
+        self._tree = None
+
+    # The hierarchy index of the table's rows, built on first use after the table was changed
+    @property
+    def tree(self) -> StateTree:
+        if self._tree is None:
+            with span('tree.index', rows=self.df.shape[0]):
+                self._tree = StateTree(self.df['Parent'].tolist(), self.df['Name'].tolist(), XMLConverter.ROOT_CHAR)
+        return self._tree
+
+    # Rebuilds the hierarchy index from the current Path and Parent columns, the dataframe may have been edited
+    # without marking the table dirty
+    def refresh_tree(self) -> StateTree:
+        self._tree = None
+        return self.tree
 
     # Creates a state table instance from a csv file
+    # A converter is created for each file since converters keep per file state and files may be opened concurrently
+    @classmethod
+    def from_csv(cls, path:str, progress: Callable[[int], None]=None) -> None:
+        return cls(CSVConverter().deserialize(path, progress=progress))
+
+    # Creates a state table instance from the first sheet of an excel file
+    @classmethod
+    def from_excel(cls, path: str, progress: Callable[[int], None]=None) -> None:
+        return cls(ExcelConverter().deserialize(path, progress=progress))
+
+    # Creates a state table instance from a parquet file written by to_parquet
     @classmethod
-    def from_csv(cls, path:str) -> None:
-        return cls(StateTable.csv_converter.deserialize(path))
+    def from_parquet(cls, path: str, progress: Callable[[int], None]=None) -> None:
+        return cls(ParquetConverter().deserialize(path, progress=progress))
 
-    # Creates a state table instance from a xml file
+    # Creates a state table instance from a xml file, streaming the file when stream is True
+    # The source file is kept as the table's xml cache, the parsed document is only kept too when keep_document is True
+    # since it takes about as much memory as the dataframe, a streamed file has no document to keep
     @classmethod
-    def from_xml(cls, path: str) -> None:
-        return cls(StateTable.xml_converter.deserialize(path))
+    def from_xml(cls, path: str, stream: bool=False, progress: Callable[[int], None]=None, keep_document: bool=False) -> None:
+        converter = XMLConverter()
+        stat = os.stat(path)
+        df = converter.deserialize(path, stream=stream, progress=progress)
+        xml_tree = converter.xml_tree if keep_document else None
+        return cls(df, xml_tree, (os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
 
     # Returns the values in a given column name or column index
     def get_column(self, col: int | str) -> list:
@@ -41,102 +101,853 @@ class StateTable():
     def get_value(self, row: int, col: int) -> str | int | float:
         return self.df.iloc[row, col]
 
+    # Returns the rows of the node at a row position and its descendants in preorder
+    def get_subtree(self, row: int) -> pd.DataFrame:
+        return self.df.iloc[self.tree.subtree(row)]
+
+    # Returns the rows of the ancestors of the node at a row position, starting with its parent
+    def get_ancestors(self, row: int) -> pd.DataFrame:
+        return self.df.iloc[[a for a in self.tree.ancestors(row) if a != self.tree.root]]
+
+    # Returns the depth of the node at a row position, state classes have depth 1
+    def get_depth(self, row: int) -> int:
+        return int(self.tree.depth[row])
+
+    # Moves the node at a row position and its subtree under the node with the given parent path
+    # The Parent and Path columns of the moved rows are rewritten and moved states take the state class of
+    # their new parent. Returns the positions of the moved rows, the table has to be checked again afterwards.
+    def reparent(self, row: int, parent: str) -> list:
+        tree = self.tree
+        parent_node = tree.node(parent)
+        if parent_node is None:
+            raise Exception(f'Invalid parent {parent}')
+
+        nodes = tree.subtree(row)
+        old_parent = self.df['Parent'].iat[row]
+        old_paths = self.df['Path'].iloc[nodes]
+        old_parents = self.df['Parent'].iloc[nodes].astype(object)
+        paths = parent + old_paths.str.slice(len(old_parent))
+        parents = parent + old_parents.str.slice(len(old_parent))
+
+        unique = self.df['Path'].isin(set(old_paths)).sum() == len(nodes) and all([tree.node(p) is None for p in paths])
+        moved = tree.reparent(row, parent_node)
+        node_types = self.df['NodeType'].iloc[nodes]
+        state_class = self._state_class(parent_node)
+
+        self.dirty = True
+        self.errors.checked = False
+        set_values(self.df, nodes, self.df.columns.get_loc('Path'), paths.tolist())
+        set_values(self.df, nodes, self.df.columns.get_loc('Parent'), parents.tolist())
+        if state_class is not None:
+            states = nodes[(node_types == 'EquipmentState').to_numpy()]
+            set_values(self.df, states, self.df.columns.get_loc('StateClass'), [state_class] * len(states))
+
+        # Paths shared with other rows change which row a path resolves to, so the index is rebuilt
+        if unique:
+            tree.rename(nodes, old_paths.tolist(), paths.tolist(), parents.tolist())
+        else:
+            self._tree = None
+        return moved.tolist()
+
+    # Returns the state class of the rows under a node, or None under the root
+    def _state_class(self, node: int) -> str:
+        if node == self.tree.root:
+            return None
+        if self.df['NodeType'].iat[node] == 'EquipmentStateClass':
+            return self.df['Name'].iat[node]
+        return self.df['StateClass'].iat[node]
+
+    # Applies a patch of upserts and deletes keyed by Path to the table and returns the number of changed rows
+    # The patch is a csv file or dataframe with a Path column, an optional Action column (upsert or delete, upsert
+    # when empty) and any of the state table columns. Upserts of existing paths set the non empty patch values,
+    # other upserts append a new row whose Parent and Name come from its path. Deletes remove the row with its subtree.
+    # Rows are appended and dropped without sorting the table and only the rows affected by the patch are revalidated,
+    # a table that wasn't checked yet is checked first.
+    # Delete targets and the parents of new rows are checked before any row is written, so an invalid patch leaves
+    # the table unchanged.
+    @instrumented('patch')
+    def apply_patch(self, patch: str | pd.DataFrame, report_all_duplicates: bool=False) -> dict:
+        patch = self._read_patch(patch)
+        checker = IncrementalStateTableChecker(self, report_all_duplicates)
+        checker.build()
+        df = self.df
+
+        # Deleted subtrees are collected from the children index, removing them only updates the checker's indexes
+        actions = patch['Action']
+        deleted = []
+        for path in patch.loc[actions == 'delete', 'Path']:
+            stack = list(checker.rows_with_path(path))
+            if not stack:
+                raise Exception(f'Invalid patch, no row with path {path} to delete')
+            while stack:
+                pos = stack.pop()
+                if pos in checker.removed or pos in deleted:
+                    continue
+                deleted.append(pos)
+                stack.extend(checker.rows_under_path(df['Path'].iat[pos]))
+        affected = checker.remove_rows(deleted)
+
+        upserts = patch.loc[actions == 'upsert']
+        existing = upserts['Path'].map(lambda path: len(checker.rows_with_path(path)) > 0).astype(bool)
+        self._check_node_types(upserts.loc[existing], checker)
+        inserts = self._patch_rows(upserts.loc[~existing], checker)
+
+        self.mark_dirty()
+        values = [c for c in upserts.columns if c not in ['Action', 'Path', 'Parent', 'Name', 'Error']]
+        updated = 0
+        for _, row in upserts.loc[existing].iterrows():
+            for pos in checker.rows_with_path(row['Path']):
+                updated += 1
+                for column in values:
+                    if pd.isna(row[column]):
+                        continue
+                    if column in checker.COLUMNS:
+                        affected |= checker.set_value(pos, column, row[column])
+                    else:
+                        set_value(df, pos, df.columns.get_loc(column), row[column])
+
+        if inserts.shape[0] > 0:
+            start = df.shape[0]
+            df = self._append_rows(df, inserts)
+            self.df = df
+            affected |= checker.add_rows(list(range(start, df.shape[0])))
+
+        checker.update(affected)
+        self.df = df.drop(index=df.index[deleted])
+        return {'updated': updated, 'inserted': inserts.shape[0], 'deleted': len(deleted)}
+
+    # Helper function that reads a patch and checks its columns and actions
+    def _read_patch(self, patch: str | pd.DataFrame) -> pd.DataFrame:
+        if not isinstance(patch, pd.DataFrame):
+            try:
+                patch = pd.read_csv(patch)
+            except:
+                raise Exception('Error reading patch file')
+
+        patch = patch.loc[:, [c for c in patch.columns if not str(c).startswith('Unnamed')]].copy()
+        unknown = set(patch.columns).difference(columns + ['Action', 'Error'])
+        if 'Path' not in patch or unknown:
+            raise Exception(f'Invalid patch columns, {"missing Path" if "Path" not in patch else unknown}')
+
+        if 'Action' not in patch:
+            patch['Action'] = 'upsert'
+        patch['Action'] = patch['Action'].fillna('upsert').astype(str).str.lower()
+        invalid = set(patch['Action']).difference(['upsert', 'delete'])
+        if invalid:
+            raise Exception(f'Invalid patch actions {invalid}')
+        return apply_schema(patch)
+
+    # Helper function that rejects a patch changing the NodeType of existing rows, turning states into classes or back
+    # changes the state classes of their subtrees so it is left to a full rebuild of the table
+    def _check_node_types(self, upserts: pd.DataFrame, checker: 'IncrementalStateTableChecker') -> None:
+        if 'NodeType' not in upserts:
+            return
+        for path, node_type in zip(upserts['Path'], upserts['NodeType']):
+            if pd.isna(node_type):
+                continue
+            for pos in checker.rows_with_path(path):
+                if self.df['NodeType'].iat[pos] != node_type:
+                    raise Exception(f'Invalid patch, NodeType of {path} can\'t be changed')
+
+    # Helper function that creates the rows appended by a patch, the parent of each row has to exist after the patch
+    def _patch_rows(self, upserts: pd.DataFrame, checker: 'IncrementalStateTableChecker') -> pd.DataFrame:
+        rows = upserts.drop(columns=['Action']).drop_duplicates('Path', keep='last').reset_index(drop=True)
+        split = rows['Path'].str.rsplit('/', n=1)
+        rows['Parent'] = split.str[0]
+        rows['Name'] = split.str[1]
+        if 'NodeType' not in rows:
+            rows['NodeType'] = 'EquipmentState'
+        rows['NodeType'] = rows['NodeType'].astype(object).fillna('EquipmentState')
+        if 'StateClass' not in rows:
+            rows['StateClass'] = None
+        rows['StateClass'] = rows['StateClass'].astype(object)
+
+        # New states take the state class of their parent
+        classes = {}
+        for index, (parent, node_type) in enumerate(zip(rows['Parent'], rows['NodeType'])):
+            if node_type == 'EquipmentStateClass':
+                classes[f'{parent}/{rows["Name"].iat[index]}'] = rows['Name'].iat[index]
+                continue
+            if parent in classes:
+                state_class = classes[parent]
+            elif checker.rows_with_path(parent):
+                pos = checker.rows_with_path(parent)[-1]
+                is_class = self.df['NodeType'].iat[pos] == 'EquipmentStateClass'
+                state_class = self.df['Name'].iat[pos] if is_class else self.df['StateClass'].iat[pos]
+            elif parent == XMLConverter.ROOT_CHAR:
+                state_class = None
+            else:
+                raise Exception(f'Invalid patch, missing parent {parent}')
+            classes[f'{parent}/{rows["Name"].iat[index]}'] = state_class
+            if pd.isna(rows['StateClass'].iat[index]):
+                rows.loc[index, 'StateClass'] = state_class
+
+        rows['Error'] = ''
+        return rows
+
+    # Helper function that appends rows to the table keeping the column types, new categories are added first
+    def _append_rows(self, df: pd.DataFrame, rows: pd.DataFrame) -> pd.DataFrame:
+        rows = rows.reindex(columns=df.columns)
+        for column in df.columns:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                categories = pd.Index(rows[column].dropna().unique()).difference(df[column].cat.categories)
+                if len(categories) > 0:
+                    df[column] = df[column].cat.add_categories(categories)
+            rows[column] = rows[column].astype(df[column].dtype)
+        start = df.index.max() + 1 if df.shape[0] > 0 else 0
+        rows.index = pd.RangeIndex(start, start + rows.shape[0])
+        return pd.concat([df, rows])
+
+    # Returns the changes from this table to another version of it
+    def diff(self, other: 'StateTable') -> 'StateTableDiff':
+        return StateTableDiff(self, other)
+
     # Writes a csv file to the given path
-    def to_csv(self, path: str='state_table') -> None:
-        StateTable.csv_converter.serialize(path, self.df)
+    def to_csv(self, path: str='state_table', progress: Callable[[int], None]=None) -> None:
+        StateTable.csv_converter.serialize(path, self.df, progress=progress)
+
+    # Writes an excel file with dropdowns for the Type, Scope and Override columns to the given path
+    def to_excel(self, path: str='state_table.xlsx', progress: Callable[[int], None]=None) -> None:
+        ExcelConverter().serialize(path, self.df, progress=progress)
+
+    # Writes a parquet file with the table's column types to the given path
+    def to_parquet(self, path: str='state_table.parquet', progress: Callable[[int], None]=None) -> None:
+        ParquetConverter().serialize(path, self.df, progress=progress)
 
     def to_dataframe(self):
         return self.df
+
+    # Returns a copy of the table that can be written on another thread while this table is edited
+    # The dataframe is copied and the clean state, cached xml document and errors are kept, the copy builds its
+    # own hierarchy index since moves update the index in place
+    def snapshot(self) -> 'StateTable':
+        snapshot = StateTable(self.df.copy(), self.xml_tree, self.xml_source)
+        snapshot.dirty = self.dirty
+        snapshot.errors = self.errors
+        return snapshot
     
-    # Writes a xml file to the given path
-    def to_xml(self, path: str='state_table', refresh: bool = False) -> None:
-        if self.xml_tree and not refresh:
-            self.xml_tree.write(path)
-        self.xml_tree = StateTable.xml_converter.serialize(path, self.df)
+    # Writes a xml file to the given path, streaming the document to the file when stream is True
+    # While the table is clean the unchanged source export is copied or the cached document is written directly,
+    # refresh forces a new serialization
+    # A converter is created for each export since the converter keeps the export's progress state
+    def to_xml(self, path: str='state_table', refresh: bool = False, stream: bool = False, progress: Callable[[int], None]=None) -> None:
+        if not self.dirty and not refresh:
+            if self._source_unchanged():
+                if os.path.abspath(path) != self.xml_source[0]:
+                    shutil.copyfile(self.xml_source[0], path)
+                ProgressReporter(progress).finish()
+                return
+            if self.xml_tree is not None:
+                self.xml_tree.write(path)
+                ProgressReporter(progress).finish()
+                return
+
+        xml_tree = XMLConverter().serialize(path, self.df, stream=stream, progress=progress, tree=self.tree)
+        self.xml_source = None
+        self.xml_tree = xml_tree
+        self.dirty = xml_tree is None
+
+    # Checks that the export the table was read from still has the same size and modification time
+    def _source_unchanged(self) -> bool:
+        if not self.xml_source:
+            return False
+        try:
+            stat = os.stat(self.xml_source[0])
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == self.xml_source[1:]
+
+# Stores the findings of the state table checks as parallel row, code and message columns
+# checked is True when the findings are the result of checking the whole table
+class StateTableErrors():
+    def __init__(self, checked: bool=False) -> None:
+        self.checked = checked
+        self.rows = []
+        self.codes = []
+        self.messages = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    # Records a finding for each row index, msg is either a single message or a list with one message per index
+    def add(self, code: str, msg: str | list, indexes: list) -> None:
+        self.rows.extend(indexes)
+        self.codes.extend([code] * len(indexes))
+        self.messages.extend(msg if isinstance(msg, list) else [msg] * len(indexes))
+
+    # Returns the findings as a dataframe with Row, Code and Message columns
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            'Row': self.rows,
+            'Code': pd.Categorical(self.codes),
+            'Message': self.messages,
+        })
+
+    # Returns the findings with the given error code
+    def filter(self, code: str) -> pd.DataFrame:
+        df = self.to_dataframe()
+        return df.loc[df['Code'] == code]
+
+    # Returns the number of findings for each error code in the order they were found
+    def counts(self) -> dict:
+        counts = {}
+        for code in self.codes:
+            counts[code] = counts.get(code, 0) + 1
+        return counts
+
+    # Returns a short description of the findings for display
+    def summary(self) -> str:
+        return ', '.join([f'{code} ({count})' for code, count in self.counts().items()])
+
+    # Builds the Error column values for the given index, joining each row's messages with ' | '
+    def error_column(self, index: pd.Index) -> pd.Series:
+        messages = {}
+        for row, msg in zip(self.rows, self.messages):
+            messages[row] = f'{messages[row]} | {msg}' if row in messages else msg
+
+        column = pd.Series('', index=index, dtype=object)
+        if len(messages) > 0:
+            column.loc[list(messages.keys())] = list(messages.values())
+        return column
 
 # Runs validation tests on a given state table
 class StateTableChecker():
 
     # Runs the tests and returns a list of errors found
-    def check_for_errors(self, state_table: StateTable) -> list:
+    # The findings are stored on the state table and the Error column is rebuilt from them once
+    # progress receives the completed percentage after each test
+    def check_for_errors(self, state_table: StateTable, report_all_duplicates: bool=False, progress: Callable[[int], None]=None) -> list:
+        with span('check', rows=state_table.get_row_count()):
+            return self._check_for_errors(state_table, report_all_duplicates, progress)
+
+    # Helper function that runs the tests inside the check span
+    def _check_for_errors(self, state_table: StateTable, report_all_duplicates: bool, progress: Callable[[int], None]) -> list:
         errors = []
+        findings = StateTableErrors(checked=True)
+        reporter = ProgressReporter(progress)
+        reporter.start_stage(4)
         df = state_table.to_dataframe()
-        duplicate_codes = self.check_duplicate_state_codes(df)
+        duplicate_codes = self.check_duplicate_state_codes(df, report_all_duplicates, findings)
         if duplicate_codes:
             errors.append(duplicate_codes)
+        reporter.update(1)
 
-        duplicate_paths = self.check_duplicate_paths(df)
+        duplicate_paths = self.check_duplicate_paths(df, findings)
         if duplicate_paths:
             errors.append(duplicate_paths)
+        reporter.update(2)
 
-        missing_parents = self.check_missing_parent(df)
+        # The full check builds its own tree so direct edits to the dataframe are seen, later uses of the tree reuse it
+        missing_parents = self.check_missing_parent(df, findings, state_table.refresh_tree())
         if missing_parents:
             errors.append(missing_parents)
+        reporter.update(3)
 
-        return errors
+        with span('check.error_column', rows=df.shape[0]):
+            df['Error'] = findings.error_column(df.index)
+        state_table.errors = findings
+        reporter.finish()
 
-    # A helper function to help identify missing parents in state paths
-    def generate_subpaths(self, path: str) -> set:
-        path_parts = path.split('/')
-        
-        subpath = path_parts[0]
-        subpaths = set([subpath])
-        for p in path_parts[1:]:
-            subpath += "/" + p
-            subpaths.add(subpath)
-        
-        return subpaths
+        return errors
 
     # A helper function to write error messages to the errors column in the state table dataframe
-    def update_error_column(self, df:pd.DataFrame, msg: str, indexes: list) -> None:
-        df.loc[indexes, 'Error'] = df.loc[indexes, 'Error'].apply(lambda x, msg: f'{x} | {msg}' if len(x) > 0 else msg, args=(msg,))
+    # msg is either a single message for every index or a list with one message per index
+    def update_error_column(self, df:pd.DataFrame, msg: str | list, indexes: list) -> None:
+        current = df.loc[indexes, 'Error']
+        msg = pd.Series(msg, index=current.index, dtype=object)
+        df.loc[indexes, 'Error'] = msg.where(current == '', current + ' | ' + msg)
+
+    # A helper function that records findings in the error store, or writes them straight to the
+    # errors column when a check is run on its own without a store
+    def record_errors(self, df: pd.DataFrame, findings: StateTableErrors, code: str, msg: str | list, indexes: list) -> None:
+        if findings is None:
+            self.update_error_column(df, msg, indexes)
+        else:
+            findings.add(code, msg, indexes)
 
     # Checks all state codes for each state class in the state table and returns a dictionary of found errors
-    def check_duplicate_state_codes(self, df: pd.DataFrame) -> dict:
-        classes = df.loc[df['StateClass'].isna() == False, 'StateClass'].unique()
-        duplicates = []
-        for c in classes:
-            t = df.loc[(df['StateClass'] == c) & (df['NodeType'] != 'EquipmentStateClass')]
-            duplicates.extend(list(t.loc[t['Code'].duplicated()].index))
+    # When report_all is True every state sharing a code is reported instead of only the repeated occurrences
+    @instrumented('check.duplicate_codes')
+    def check_duplicate_state_codes(self, df: pd.DataFrame, report_all: bool=False, findings: StateTableErrors=None) -> dict:
+        states = df.loc[df['StateClass'].notna() & (df['NodeType'] != 'EquipmentStateClass'), ['StateClass', 'Code']]
+        duplicated = states.duplicated(keep=False if report_all else 'first')
+        duplicates = list(states.index[duplicated])
         
         if len(duplicates) > 0:
-            self.update_error_column(df, 'Duplicate State Code', duplicates)
+            self.record_errors(df, findings, 'Duplicate State Code', 'Duplicate State Code', duplicates)
             return {'error': 'Duplicate State Code', 'indexes': duplicates}
 
         return {}
 
     # Checks all the state paths in the state table for duplicates and returns a dictionary of found errors
-    def check_duplicate_paths(self, df: pd.DataFrame) -> dict:
+    @instrumented('check.duplicate_paths')
+    def check_duplicate_paths(self, df: pd.DataFrame, findings: StateTableErrors=None) -> dict:
         duplicates = []
 
         duplicates.extend(list(df.loc[df['Path'].duplicated()].index))
         
         if len(duplicates) > 0:
-            self.update_error_column(df, 'Duplicate Path', duplicates)
+            self.record_errors(df, findings, 'Duplicate Path', 'Duplicate Path', duplicates)
             return {'error': 'Duplicate Path', 'indexes': duplicates}
 
         return {}
 
     # Checks all state paths for missing parents in the path and returns a dictionary with the missing parent paths
-    def check_missing_parent(self, df: pd.DataFrame) -> dict:
-        parents = set(list(df.loc[0, 'Parent']))
+    # The rows with missing ancestors are the subtrees of the rows whose parent doesn't exist in the tree index,
+    # their missing ancestors are resolved once per unique parent, the first path segment is the root and is never a row
+    @instrumented('check.missing_parents')
+    def check_missing_parent(self, df: pd.DataFrame, findings: StateTableErrors=None, tree: StateTree=None) -> dict:
+        if tree is None:
+            tree = StateTree(df['Parent'].tolist(), df['Name'].tolist())
         error_msg = 'Missing parents'
-        errors = []
 
-        for i, p in df['Parent'].items():
-            if p in parents:
-                parents.add(df.loc[i, 'Path'])
-                continue
-            subpaths = self.generate_subpaths(p)
-            missing_parents = subpaths.difference(parents)
-            if len(missing_parents) > 0:
-                self.update_error_column(df, f'{error_msg}: {missing_parents}', [i])
-                errors.append({'index': i, 'content': missing_parents})
-        
-        if len(errors) > 0:
-            return {'error': 'Missing parents', 'indexes': errors}
+        # The parent path nodes and their ancestors in the tree's path trie are walked top down, the missing
+        # ones are the nodes below the first segment without a row
+        rows = []
+        missing = {}
+        trie = tree.trie
+        for orphan in tree.orphans():
+            subtree = tree.subtree(orphan)
+            for row in subtree.tolist():
+                p = int(tree.parent_nodes[row])
+                if p not in missing:
+                    chain = reversed([p] + trie.ancestors(p))
+                    missing[p] = set([trie.path(n) for n in chain if trie.depth[n] > 0 and tree.row(n) < 0])
+                if len(missing[p]) > 0:
+                    rows.append(row)
 
-        return {}
+        if len(rows) == 0:
+            return {}
+
+        rows.sort()
+        indexes = list(df.index[rows])
+        contents = [missing[int(tree.parent_nodes[row])] for row in rows]
+        self.record_errors(df, findings, error_msg, [f'{error_msg}: {c}' for c in contents], indexes)
+        errors = [{'index': i, 'content': c} for i, c in zip(indexes, contents)]
+
+        return {'error': 'Missing parents', 'indexes': errors}
+
+# Keeps the state table's errors up to date while single cells are edited
+# Paths, state codes per class and children per parent path are indexed by row position, so an edit only
+# revalidates the rows whose errors can change. The indexes are built on the first edit.
+# The path and children indexes are keyed by the nodes of a path trie of interned segments, so finding the rows below
+# a changed path and the missing ancestors of a row walk integer nodes instead of generating and splitting subpaths.
+class IncrementalStateTableChecker():
+    COLUMNS = ['Name', 'Code', 'Parent', 'StateClass']
+    CHECKS = ['Duplicate State Code', 'Duplicate Path', 'Missing parents']
+
+    def __init__(self, state_table: StateTable, report_all_duplicates: bool=False) -> None:
+        self.state_table = state_table
+        self.report_all_duplicates = report_all_duplicates
+        self.checker = StateTableChecker()
+        self.paths = None
+
+    # Indexes the table, the full checks only run when the table wasn't checked yet or check is True
+    # The errors of a checked table are reused so the first edit of an opened table doesn't check it again
+    def build(self, check: bool=False) -> None:
+        if check or not self.state_table.errors.checked:
+            self.checker.check_for_errors(self.state_table, self.report_all_duplicates)
+        df = self.state_table.to_dataframe()
+        self.removed = set()
+        self.labels = df.index.to_list()
+        self.positions = {label: pos for pos, label in enumerate(self.labels)}
+        self.columns = {c: df.columns.get_loc(c) for c in ['NodeType', 'StateClass', 'Code', 'Name', 'Parent', 'Path', 'Error']}
+
+        self.trie = PathTrie()
+        self.paths = {}
+        self.children = {}
+        self.codes = {}
+        parent_nodes, path_nodes = self.trie.add_rows(df['Parent'].tolist(), df['Name'].tolist())
+        rows = zip(path_nodes, parent_nodes, df['NodeType'].tolist(), df['StateClass'].tolist(), df['Code'].tolist())
+        for pos, (path, parent, node_type, state_class, code) in enumerate(rows):
+            self.children.setdefault(parent, set()).add(pos)
+            self.paths.setdefault(path, []).append(pos)
+            # Same keys as _code_key, read from the column lists
+            if not pd.isna(state_class) and node_type != 'EquipmentStateClass':
+                self.codes.setdefault((state_class, None if pd.isna(code) else code), []).append(pos)
+
+        self.row_errors = {}
+        errors = self.state_table.errors
+        for label, code, msg in zip(errors.rows, errors.codes, errors.messages):
+            self.row_errors.setdefault(self.positions[label], {})[code] = msg
+
+    # Writes a value to the Name, Code, Parent or StateClass column of the row at a position and revalidates
+    # the affected rows, renamed or moved nodes take their subtree with them
+    # Returns the positions of every row with changed values
+    def set_value(self, pos: int, column: str, value) -> set:
+        if self.paths is None:
+            self.build()
+
+        self.state_table.mark_dirty()
+        changed = set([pos])
+        affected = set([pos])
+        if column in ['Code', 'StateClass']:
+            affected |= self._remove_code(pos)
+            self._set(pos, column, value)
+            affected |= self._add_code(pos)
+        else:
+            old_parent = self._get(pos, 'Parent')
+            self._set(pos, column, value)
+            parent = self._get(pos, 'Parent')
+            changed |= self._move(pos, old_parent, parent, f'{parent}/{self._get(pos, "Name")}', affected)
+
+        self._update_errors(affected)
+        return changed | affected
+
+    # Indexes rows appended to the end of the table and returns the rows whose errors can change
+    def add_rows(self, positions: list) -> set:
+        df = self.state_table.to_dataframe()
+        affected = set(positions)
+        changed_paths = set()
+        for pos in positions:
+            label = df.index[pos]
+            self.labels.append(label)
+            self.positions[label] = pos
+            affected |= self._add_code(pos)
+            self.children.setdefault(self._node(pos, 'Parent'), set()).add(pos)
+            path = self._node(pos, 'Path')
+            rows = self.paths.setdefault(path, [])
+            if not rows:
+                changed_paths.add(path)
+            bisect.insort(rows, pos)
+            affected |= set(rows)
+
+        return affected | self._rows_under(changed_paths)
+
+    # Removes rows from the indexes before they are dropped from the table and returns the rows whose errors can change
+    def remove_rows(self, positions: list) -> set:
+        affected = set()
+        changed_paths = set()
+        for pos in positions:
+            affected |= self._remove_code(pos)
+            parent = self._node(pos, 'Parent')
+            self.children[parent].discard(pos)
+            if not self.children[parent]:
+                del self.children[parent]
+            path = self._node(pos, 'Path')
+            rows = self.paths[path]
+            rows.remove(pos)
+            if not rows:
+                del self.paths[path]
+                changed_paths.add(path)
+            affected |= set(rows)
+            self.row_errors.pop(pos, None)
+            self.removed.add(pos)
+
+        return (affected | self._rows_under(changed_paths)) - self.removed
+
+    # Revalidates the given rows and rebuilds the error store
+    def update(self, positions: set) -> None:
+        self._update_errors(positions)
+
+    # Returns the rows whose parent path has one of the given path nodes as an ancestor or is one of them
+    def _rows_under(self, paths: set) -> set:
+        rows = set()
+        for path in paths:
+            for node in self.trie.subtree(path):
+                rows |= self.children.get(node, set())
+        return rows
+
+    # Returns the rows with a path, or an empty list
+    def rows_with_path(self, path: str) -> list:
+        return self.paths.get(self.trie.find(path), [])
+
+    # Returns the rows whose parent is a path
+    def rows_under_path(self, path: str) -> set:
+        return self.children.get(self.trie.find(path), set())
+
+    def _get(self, pos: int, column: str):
+        return self.state_table.df.iat[pos, self.columns[column]]
+
+    # Returns the trie node of the Path or Parent value of a row
+    def _node(self, pos: int, column: str) -> int:
+        return self.trie.add(self._get(pos, column))
+
+    def _set(self, pos: int, column: str, value) -> None:
+        set_value(self.state_table.df, pos, self.columns[column], value)
+
+    # Returns the key of a state row in the code index, or None for rows that aren't checked for duplicate codes
+    def _code_key(self, pos: int) -> tuple:
+        state_class = self._get(pos, 'StateClass')
+        if pd.isna(state_class) or self._get(pos, 'NodeType') == 'EquipmentStateClass':
+            return None
+        code = self._get(pos, 'Code')
+        return (state_class, None if pd.isna(code) else code)
+
+    # Adds a row to the code index and returns the rows sharing its code
+    def _add_code(self, pos: int) -> set:
+        key = self._code_key(pos)
+        if key is None:
+            return set()
+        rows = self.codes.setdefault(key, [])
+        bisect.insort(rows, pos)
+        return set(rows)
+
+    # Removes a row from the code index and returns the rows that shared its code
+    def _remove_code(self, pos: int) -> set:
+        key = self._code_key(pos)
+        if key is None:
+            return set()
+        rows = self.codes[key]
+        rows.remove(pos)
+        if not rows:
+            del self.codes[key]
+        return set(rows)
+
+    # Moves a row to a new path with all of its descendants and returns the moved positions
+    # The subtree only moves with the row when no other row has the same path
+    def _move(self, pos: int, old_parent: str, parent: str, path: str, affected: set) -> set:
+        old_path = self._get(pos, 'Path')
+        moves = [(pos, parent, path)]
+        if len(self.paths[self.trie.find(old_path)]) == 1 and old_path != path:
+            stack = [(old_path, path)]
+            while stack:
+                old, new = stack.pop()
+                for child in self.rows_under_path(old):
+                    child_path = new + self._get(child, 'Path')[len(old):]
+                    moves.append((child, new, child_path))
+                    stack.append((self._get(child, 'Path'), child_path))
+
+        changed_paths = set()
+        for child, new_parent, new_path in moves:
+            current_parent = self.trie.find(old_parent if child == pos else self._get(child, 'Parent'))
+            current_path = self._get(child, 'Path')
+            self.children[current_parent].discard(child)
+            if not self.children[current_parent]:
+                del self.children[current_parent]
+            self.children.setdefault(self.trie.add(new_parent), set()).add(child)
+
+            current_node = self.trie.find(current_path)
+            affected |= set(self.paths[current_node])
+            self.paths[current_node].remove(child)
+            if not self.paths[current_node]:
+                del self.paths[current_node]
+                changed_paths.add(current_node)
+            new_node = self.trie.add(new_path)
+            rows = self.paths.setdefault(new_node, [])
+            if not rows:
+                changed_paths.add(new_node)
+            bisect.insort(rows, child)
+            affected |= set(rows)
+
+            self._set(child, 'Parent', new_parent)
+            self._set(child, 'Path', new_path)
+            self._update_state_class(child, current_path, new_path, affected)
+            affected.add(child)
+
+        # Rows under a path that appeared or disappeared may have gained or lost missing parents
+        affected |= self._rows_under(changed_paths)
+
+        return set([m[0] for m in moves])
+
+    # Keeps the state class of a moved state row in step with the class segment of its path
+    def _update_state_class(self, pos: int, old_path: str, new_path: str, affected: set) -> None:
+        if self._get(pos, 'NodeType') == 'EquipmentStateClass':
+            return
+        old_parts = old_path.split('/')
+        new_parts = new_path.split('/')
+        if len(old_parts) < 3 or len(new_parts) < 3 or self._get(pos, 'StateClass') != old_parts[1]:
+            return
+        if old_parts[1] == new_parts[1]:
+            return
+        affected |= self._remove_code(pos)
+        self._set(pos, 'StateClass', new_parts[1])
+        affected |= self._add_code(pos)
+
+    # Recomputes the errors of the given rows and rebuilds the Error column values and the error store
+    def _update_errors(self, positions: set) -> None:
+        for pos in positions - self.removed:
+            errors = {}
+            key = self._code_key(pos)
+            if key is not None:
+                rows = self.codes[key]
+                if len(rows) > 1 and (self.report_all_duplicates or rows[0] != pos):
+                    errors['Duplicate State Code'] = 'Duplicate State Code'
+
+            if self.paths[self._node(pos, 'Path')][0] != pos:
+                errors['Duplicate Path'] = 'Duplicate Path'
+
+            # The parent and its ancestors below the top segment are walked top down like the full check
+            parent = self._node(pos, 'Parent')
+            chain = [parent] + self.trie.ancestors(parent)
+            missing = [n for n in reversed(chain) if self.trie.depth[n] > 0 and n not in self.paths]
+            if missing:
+                errors['Missing parents'] = f'Missing parents: {set([self.trie.path(n) for n in missing])}'
+
+            if errors:
+                self.row_errors[pos] = errors
+            else:
+                self.row_errors.pop(pos, None)
+            self._set(pos, 'Error', ' | '.join(errors.values()))
+
+        findings = StateTableErrors(checked=True)
+        for code in self.CHECKS:
+            rows = sorted([pos for pos, errors in self.row_errors.items() if code in errors])
+            if rows:
+                findings.add(code, [self.row_errors[pos][code] for pos in rows], [self.labels[pos] for pos in rows])
+        self.state_table.errors = findings
+
+# The changes from an old to a new version of a state table
+# Rows are joined on Path with repeated paths paired in order. The states left over are paired on StateClass and
+# Code as renamed or moved states, then on Code and their path below the state class so the states of a renamed
+# state class are followed too, and the classes they moved between are paired. Every step is a hash join or a
+# vectorized comparison so the diff stays linear in the table sizes.
+class StateTableDiff():
+    FIELDS = ['NodeType', 'StateClass', 'Name', 'OverrideCurrentLineDowntime', 'Code', 'Type', 'ShortStopThreshold', 'EnableMeantimeMetrics', 'Override', 'Scope', 'Roles']
+    CHANGES = ['Added', 'Removed', 'Renamed', 'Moved', 'Changed']
+
+    def __init__(self, old: StateTable, new: StateTable) -> None:
+        self.old = old.to_dataframe()
+        self.new = new.to_dataframe()
+        self.changes = self._compare()
+
+    def __len__(self) -> int:
+        return self.changes.shape[0]
+
+    # Returns the changes as a dataframe with Change, Path, NewPath, Fields, Row and NewRow columns
+    # Row and NewRow are the row positions in the old and new tables, Fields lists the changed fields
+    def to_dataframe(self) -> pd.DataFrame:
+        return self.changes
+
+    # Returns the changes of the given kind
+    def filter(self, change: str) -> pd.DataFrame:
+        return self.changes.loc[self.changes['Change'] == change]
+
+    # Returns the number of changes of each kind
+    def counts(self) -> dict:
+        counts = self.changes['Change'].value_counts()
+        return {c: int(counts[c]) for c in self.CHANGES if counts.get(c, 0) > 0}
+
+    # Returns a short description of the changes for display
+    def summary(self) -> str:
+        return ', '.join([f'{change} ({count})' for change, count in self.counts().items()])
+
+    def _compare(self) -> pd.DataFrame:
+        old_keys, new_keys = self._path_keys(self.old), self._path_keys(self.new)
+        joined = old_keys.merge(new_keys, on=['Path', 'Occurrence'], how='outer', suffixes=('', 'New'), indicator=True)
+        same = joined.loc[joined['_merge'] == 'both']
+        removed = joined.loc[joined['_merge'] == 'left_only', 'Row'].astype('int64').to_numpy()
+        added = joined.loc[joined['_merge'] == 'right_only', 'RowNew'].astype('int64').to_numpy()
+
+        parts = [self._changed(same['Row'].astype('int64').to_numpy(), same['RowNew'].astype('int64').to_numpy(), self.FIELDS)]
+
+        matches = []
+        for keys in [self._code_keys, self._suffix_keys]:
+            old_rows, new_rows = self._match(keys(self.old, removed), keys(self.new, added))
+            matches.append((old_rows, new_rows))
+            removed = np.setdiff1d(removed, old_rows)
+            added = np.setdiff1d(added, new_rows)
+
+        old_rows, new_rows = self._match_classes(matches[1][0], matches[1][1], removed, added)
+        removed = np.setdiff1d(removed, old_rows)
+        added = np.setdiff1d(added, new_rows)
+        matches.append((old_rows, new_rows))
+
+        fields = [f for f in self.FIELDS if f not in ['Name', 'StateClass']]
+        for old_rows, new_rows in matches:
+            parts.append(self._moved(old_rows, new_rows, fields))
+
+        parts.append(self._rows('Removed', removed, None))
+        parts.append(self._rows('Added', None, added))
+        changes = pd.concat(parts, ignore_index=True)
+        order = changes['NewPath'].fillna(changes['Path']).sort_values(kind='stable').index
+        return changes.loc[order].reset_index(drop=True)
+
+    # Helper function that returns the path of each row with its occurrence number among rows with the same path
+    def _path_keys(self, df: pd.DataFrame) -> pd.DataFrame:
+        keys = pd.DataFrame({'Path': df['Path'].to_numpy(), 'Row': np.arange(df.shape[0])})
+        keys['Occurrence'] = keys.groupby('Path', sort=False).cumcount()
+        return keys
+
+    # Helper function that returns the StateClass and Code keys of the state rows among the given rows
+    def _code_keys(self, df: pd.DataFrame, rows: np.ndarray) -> pd.DataFrame:
+        keys = pd.DataFrame({
+            'Row': rows,
+            'NodeType': self._values(df, 'NodeType', rows),
+            'StateClass': self._values(df, 'StateClass', rows),
+            'Code': self._values(df, 'Code', rows),
+        })
+        keys = keys.loc[(keys['NodeType'] == 'EquipmentState') & (keys['Code'] != '')]
+        return keys[['Row', 'StateClass', 'Code']]
+
+    # Helper function that returns the Code and the path below the state class of the state rows among the given rows
+    def _suffix_keys(self, df: pd.DataFrame, rows: np.ndarray) -> pd.DataFrame:
+        keys = self._code_keys(df, rows)
+        keys['Suffix'] = df['Path'].iloc[keys['Row']].str.split('/', n=2).str[2].to_numpy()
+        return keys[['Row', 'Code', 'Suffix']].dropna()
+
+    # Helper function that pairs old and new rows with equal keys, keys shared by several rows on either side are ambiguous and skipped
+    def _match(self, old_keys: pd.DataFrame, new_keys: pd.DataFrame) -> tuple:
+        on = [c for c in old_keys.columns if c != 'Row']
+        old_keys = old_keys.loc[~old_keys.duplicated(on, keep=False)]
+        new_keys = new_keys.loc[~new_keys.duplicated(on, keep=False)]
+        pairs = old_keys.merge(new_keys, on=on, suffixes=('', 'New'))
+        return pairs['Row'].to_numpy(dtype='int64'), pairs['RowNew'].to_numpy(dtype='int64')
+
+    # Helper function that pairs the removed and added state classes that most of the followed states moved between
+    def _match_classes(self, old_states: np.ndarray, new_states: np.ndarray, removed: np.ndarray, added: np.ndarray) -> tuple:
+        moves = pd.DataFrame({
+            'Old': self._values(self.old, 'StateClass', old_states),
+            'New': self._values(self.new, 'StateClass', new_states),
+        })
+        moves = moves.value_counts().reset_index()
+        moves = moves.loc[~moves['Old'].duplicated() & ~moves['New'].duplicated()]
+
+        old_classes = self._class_rows(self.old, removed)
+        new_classes = self._class_rows(self.new, added)
+        pairs = moves.merge(old_classes, left_on='Old', right_on='Name').merge(new_classes, left_on='New', right_on='Name', suffixes=('', 'New'))
+        return pairs['Row'].to_numpy(dtype='int64'), pairs['RowNew'].to_numpy(dtype='int64')
+
+    # Helper function that returns the name of the top level state class rows among the given rows
+    def _class_rows(self, df: pd.DataFrame, rows: np.ndarray) -> pd.DataFrame:
+        classes = pd.DataFrame({
+            'Row': rows,
+            'NodeType': self._values(df, 'NodeType', rows),
+            'Name': self._values(df, 'Name', rows),
+            'Parent': self._values(df, 'Parent', rows),
+        })
+        classes = classes.loc[(classes['NodeType'] == 'EquipmentStateClass') & (classes['Parent'] == XMLConverter.ROOT_CHAR)]
+        return classes.loc[~classes['Name'].duplicated(keep=False), ['Row', 'Name']]
+
+    # Helper function that returns the values of a column at row positions as objects, missing values are empty text
+    # so tables read from different file types compare equal
+    def _values(self, df: pd.DataFrame, column: str, rows: np.ndarray) -> np.ndarray:
+        values = df[column].iloc[rows].astype(object)
+        return values.where(values.notna(), '').to_numpy()
+
+    # Helper function that returns the names of the fields that differ between paired rows, joined with ', '
+    def _field_changes(self, old_rows: np.ndarray, new_rows: np.ndarray, fields: list) -> np.ndarray:
+        changes = np.full(len(old_rows), '', dtype=object)
+        for field in fields:
+            differs = np.flatnonzero(self._values(self.old, field, old_rows) != self._values(self.new, field, new_rows))
+            changes[differs] = [f'{c}, {field}' if c else field for c in changes[differs]]
+        return changes
+
+    # Helper function that returns the paired rows with the same path that have changed fields
+    def _changed(self, old_rows: np.ndarray, new_rows: np.ndarray, fields: list) -> pd.DataFrame:
+        changes = self._field_changes(old_rows, new_rows, fields)
+        changed = changes != ''
+        return self._rows('Changed', old_rows[changed], new_rows[changed], changes[changed])
+
+    # Helper function that returns paired rows with different paths as renamed when they have the same parent or moved otherwise
+    def _moved(self, old_rows: np.ndarray, new_rows: np.ndarray, fields: list) -> pd.DataFrame:
+        same_parent = self._values(self.old, 'Parent', old_rows) == self._values(self.new, 'Parent', new_rows)
+        rows = self._rows('Moved', old_rows, new_rows, self._field_changes(old_rows, new_rows, fields))
+        rows.loc[same_parent, 'Change'] = 'Renamed'
+        return rows
+
+    # Helper function that creates change rows for old and new row positions, either may be None for removed or added rows
+    def _rows(self, change: str, old_rows: np.ndarray, new_rows: np.ndarray, fields: np.ndarray=None) -> pd.DataFrame:
+        count = len(old_rows if old_rows is not None else new_rows)
+        missing = pd.Series(pd.NA, index=range(count), dtype='Int64')
+        return pd.DataFrame({
+            'Change': [change] * count,
+            'Path': self.old['Path'].iloc[old_rows].to_numpy() if old_rows is not None else [None] * count,
+            'NewPath': self.new['Path'].iloc[new_rows].to_numpy() if new_rows is not None else [None] * count,
+            'Fields': fields if fields is not None else [''] * count,
+            'Row': pd.array(old_rows, dtype='Int64') if old_rows is not None else missing,
+            'NewRow': pd.array(new_rows, dtype='Int64') if new_rows is not None else missing,
+        })
 
 if __name__ == '__main__':
     state_table = StateTable().from_csv('states_table.csv')
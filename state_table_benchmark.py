@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.sax.saxutils import escape
+import pandas as pd
+from conversions import CSVConverter, XMLConverter
+from state_table import StateTable, StateTableChecker
+
+# Benchmarks of the converters, the checker and the preview model on generated state class exports
+# Usage: python -m state_table_benchmark --rows 1000 10000 100000 --output results.json [--compare previous.json]
+
+STATE_TYPES = ['Blocked', 'Disabled', 'Idle', 'Planned Downtime', 'Running', 'Starved', 'Unplanned Downtime']
+STATE_NAMES = ['Running', 'Idle', 'Blocked', 'Starved', 'Planned Downtime', 'Unplanned Downtime', 'Changeover', 'Café & Break']
+
+# Writes a generated EquipmentStateRoot export with the layout of a Sepasoft export
+# Each class gets states spread over up to depth levels, every state picks a random parent among the states
+# above the last level. Duplicate codes reuse a code of the class and duplicate paths reuse a sibling's name
+# at the given rates. Returns the number of rows the export has as a state table.
+def generate_export(path: str, classes: int=10, states: int=100, depth: int=3, duplicate_code_rate: float=0.0,
+                    duplicate_path_rate: float=0.0, seed: int=0) -> int:
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<EquipmentStateRoot>')
+        for class_index in range(classes):
+            file.write(f'\n  <EquipmentStateClass>\n    <Name>Class {class_index}</Name>'
+                       f'\n    <OverrideCurrentLineDowntime>{rng.choice(["true", "false"])}</OverrideCurrentLineDowntime>')
+            if class_index % 2:
+                file.write('\n    <Roles>\n      <Role>Administrator</Role>\n      <Role>Operator</Role>\n    </Roles>')
+            else:
+                file.write('\n    <Roles/>')
+            file.write(''.join(_class_states(rng, states, depth, duplicate_code_rate, duplicate_path_rate)))
+            file.write('\n  </EquipmentStateClass>')
+        file.write('\n</EquipmentStateRoot>\n')
+
+    return classes * (states + 1)
+
+# Helper function that returns the xml text parts of the states of one class in document order
+def _class_states(rng: random.Random, states: int, depth: int, duplicate_code_rate: float, duplicate_path_rate: float) -> list:
+    # Node 0 is the class, nodes are (level, children, name, code)
+    nodes = [(0, [], None, None)]
+    parents = [0]
+    codes = []
+    for index in range(states):
+        parent = rng.choice(parents)
+        level = nodes[parent][0] + 1
+        siblings = nodes[parent][1]
+        if siblings and rng.random() < duplicate_path_rate:
+            name = nodes[rng.choice(siblings)][2]
+        else:
+            name = f'{rng.choice(STATE_NAMES)} {index}'
+        code = rng.choice(codes) if codes and rng.random() < duplicate_code_rate else index + 1
+        codes.append(code)
+        nodes.append((level, [], name, code))
+        siblings.append(len(nodes) - 1)
+        if level < depth:
+            parents.append(len(nodes) - 1)
+
+    parts = []
+    stack = [(child, False) for child in reversed(nodes[0][1])]
+    while stack:
+        node, closing = stack.pop()
+        level, children, name, code = nodes[node]
+        indent = '\n' + '  ' * (level + 1)
+        if closing:
+            parts.append(f'{indent}</EquipmentState>')
+            continue
+        inner = indent + '  '
+        parts.append(f'{indent}<EquipmentState>{inner}<Name>{escape(name)}</Name>{inner}<Code>{code}</Code>'
+                     f'{inner}<Type>{rng.choice(STATE_TYPES)}</Type>{inner}<ShortStopThreshold>{rng.choice([0, 0, 30, 60])}</ShortStopThreshold>'
+                     f'{inner}<EnableMeantimeMetrics>{rng.choice(["true", "false"])}</EnableMeantimeMetrics>'
+                     f'{inner}<OverrideCurrentLineDowntime>true</OverrideCurrentLineDowntime>'
+                     f'{inner}<Override>Optional</Override>{inner}<Scope>Detected Equipment State</Scope>')
+        stack.append((node, True))
+        stack.extend([(child, False) for child in reversed(children)])
+    return parts
+
+# Moves a share of the leaf states under parent paths that don't exist, exports can't have missing parents
+# so they are only injected into the csv tables
+def inject_missing_parents(df: pd.DataFrame, rate: float, seed: int=0) -> pd.DataFrame:
+    df = df.copy()
+    df['Parent'] = df['Parent'].astype(object)
+    leaves = df.index[(df['NodeType'] == 'EquipmentState') & ~df['Path'].isin(set(df['Parent']))]
+    moved = pd.Series(leaves).sample(frac=rate, random_state=seed).tolist()
+    df.loc[moved, 'Parent'] = df.loc[moved, 'Parent'] + '/Missing'
+    df.loc[moved, 'Path'] = df.loc[moved, 'Parent'] + '/' + df.loc[moved, 'Name']
+    return df
+
+# Runs a function repeat times and returns its timings, peak memory is measured in an extra traced run
+# since tracing slows the function down
+def measure(function, repeat: int=3, memory: bool=True) -> dict:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+
+    result = {'seconds_min': round(min(seconds), 4), 'seconds_median': round(statistics.median(seconds), 4)}
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        finally:
+            tracemalloc.stop()
+    return result
+
+# Creates the preview model and pages through every row like a scrolling view, reading the cells of
+# one screen of rows per page. Returns None when PySide6 isn't installed.
+def model_scroll(df: pd.DataFrame, page_size: int=40):
+    try:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PySide6.QtCore import QModelIndex, Qt
+        from PySide6.QtWidgets import QApplication
+        from state_table_widget import DataFrameTableModel
+    except ImportError:
+        return None
+
+    app = QApplication.instance() or QApplication([])
+    def scroll():
+        model = DataFrameTableModel(df)
+        for first in range(0, df.shape[0], page_size):
+            while first + page_size > model.rowCount() and model.canFetchMore(QModelIndex()):
+                model.fetchMore(QModelIndex())
+            for row in range(first, min(first + page_size, model.rowCount())):
+                for col in range(model.columnCount()):
+                    model.data(model.index(row, col), Qt.ItemDataRole.DisplayRole)
+    return scroll
+
+# Generates the inputs for one table size and benchmarks every step on them
+def run_size(rows: int, args: argparse.Namespace, directory: str) -> list:
+    classes = max(1, min(args.classes, rows // 2))
+    states = max(1, rows // classes - 1)
+    xml_path = os.path.join(directory, f'export_{rows}.xml')
+    generate_export(xml_path, classes, states, args.depth, args.duplicate_code_rate, args.duplicate_path_rate, args.seed)
+
+    xml_df = XMLConverter().deserialize(xml_path)
+    csv_df = inject_missing_parents(xml_df, args.missing_parent_rate, args.seed)
+    csv_path = os.path.join(directory, f'table_{rows}.csv')
+    CSVConverter().serialize(csv_path, csv_df)
+    csv_df = CSVConverter().deserialize(csv_path)
+    out_path = os.path.join(directory, 'out')
+
+    # Checking adds Error values, so each run gets its own table
+    def check():
+        StateTableChecker().check_for_errors(StateTable(csv_df.copy()))
+
+    benchmarks = {
+        'xml_deserialize': lambda: XMLConverter().deserialize(xml_path),
+        'xml_deserialize_stream': lambda: XMLConverter().deserialize(xml_path, stream=True),
+        'xml_serialize': lambda: XMLConverter().serialize(out_path, xml_df),
+        'xml_serialize_stream': lambda: XMLConverter().serialize(out_path, xml_df, stream=True),
+        'csv_deserialize': lambda: CSVConverter().deserialize(csv_path),
+        'csv_serialize': lambda: CSVConverter().serialize(out_path, csv_df),
+        'check_for_errors': check,
+        'model_scroll': model_scroll(xml_df),
+    }
+
+    state_table = StateTable(csv_df.copy())
+    StateTableChecker().check_for_errors(state_table)
+    table = {'rows': xml_df.shape[0], 'classes': classes, 'errors': state_table.errors.counts()}
+
+    results = []
+    for name, function in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        if function is None:
+            results.append({'benchmark': name, 'size': rows, 'skipped': 'PySide6 is not installed'})
+            continue
+        result = {'benchmark': name, 'size': rows, **table, **measure(function, args.repeat, not args.no_memory)}
+        results.append(result)
+        print(f'{name} {rows}: {result["seconds_min"]}s', file=sys.stderr)
+    return results
+
+# Returns the current commit of the working directory, or None outside of a git checkout
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+# Prints the ratio of each benchmark's best time to the best time in a previous results file
+def compare(results: list, previous_path: str, threshold: float) -> int:
+    with open(previous_path) as file:
+        previous = {(r['benchmark'], r['size']): r for r in json.load(file)['results'] if 'seconds_min' in r}
+
+    regressions = 0
+    for result in results:
+        old = previous.get((result['benchmark'], result['size']))
+        if old is None or 'seconds_min' not in result:
+            continue
+        ratio = result['seconds_min'] / max(old['seconds_min'], 1e-6)
+        flag = ''
+        if ratio > threshold:
+            regressions += 1
+            flag = ' regression'
+        print(f'{result["benchmark"]} {result["size"]}: {old["seconds_min"]}s -> {result["seconds_min"]}s ({ratio:.2f}x){flag}', file=sys.stderr)
+    return regressions
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='state_table_benchmark', description='Benchmark the converters, checker and preview model on generated state class exports.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000], help='Table sizes to generate')
+    parser.add_argument('--classes', type=int, default=10, help='Number of state classes')
+    parser.add_argument('--depth', type=int, default=3, help='Maximum nesting depth of the states')
+    parser.add_argument('--duplicate-code-rate', type=float, default=0.01, help='Share of states reusing a code of their class')
+    parser.add_argument('--duplicate-path-rate', type=float, default=0.01, help='Share of states reusing a sibling\'s name')
+    parser.add_argument('--missing-parent-rate', type=float, default=0.01, help='Share of leaf states moved under a missing parent in the csv tables')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated exports')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each benchmark')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced run measuring peak memory')
+    parser.add_argument('--only', nargs='+', help='Run only the named benchmarks')
+    parser.add_argument('-o', '--output', help='Write the json results to this file instead of stdout')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare the timings with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Slowdown ratio reported as a regression by --compare')
+    return parser
+
+# Runs the benchmarks and returns the exit code, 1 when --compare finds regressions
+def main(argv: list=None) -> int:
+    args = create_parser().parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        results = []
+        for rows in args.rows:
+            results.extend(run_size(rows, args, directory))
+
+    parameters = {k: v for k, v in vars(args).items() if k not in ['output', 'compare', 'threshold']}
+    report = {
+        'commit': get_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
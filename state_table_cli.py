@@ -0,0 +1,214 @@
+import argparse
+import cProfile
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import instrumentation
+from parse_cache import ParseCache
+from state_table import StateTable, StateTableChecker
+
+# Command line entry point for converting and validating state table files without the GUI
+# Usage: python -m state_table_cli {convert,validate} [options] inputs...
+
+EXTENSIONS = ['csv', 'parquet', 'xlsx', 'xml']
+
+# Expands files, glob patterns and directories into a sorted list of unique state table file paths
+def expand_inputs(inputs: list, recursive: bool=False) -> list:
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            sub_pattern = '**/*' if recursive else '*'
+            matches = glob.glob(os.path.join(pattern, sub_pattern), recursive=recursive)
+        else:
+            matches = glob.glob(pattern, recursive=True) or [pattern]
+
+        for match in matches:
+            if os.path.isdir(match):
+                continue
+            if os.path.isdir(pattern) and get_extension(match) not in EXTENSIONS:
+                continue
+            paths.append(os.path.normpath(match))
+
+    return sorted(set(paths))
+
+def get_extension(path: str) -> str:
+    return path.split('.')[-1].lower()
+
+# Returns the output path for a converted file, using the input's directory when no output directory is given
+def get_output_path(path: str, to: str, output_dir: str=None) -> str:
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_dir or os.path.dirname(path), f'{name}.{to}')
+
+# Opens, validates and optionally converts a single file and returns its report entry
+# Runs in the worker processes so it only receives and returns plain data
+def process_file(task: dict) -> dict:
+    path = task['path']
+    report = {'input': path, 'status': 'ok'}
+    if task.get('diagnostics'):
+        instrumentation.clear()
+        instrumentation.enable(trace_memory=task['trace_memory'])
+    start = time.perf_counter()
+    try:
+        extension = get_extension(path)
+        if extension not in EXTENSIONS:
+            raise Exception(f'Unsupported file type {extension}')
+
+        # Cache entries made with different checker options are kept apart
+        cache = ParseCache(task['cache_dir']) if task['cache_dir'] else None
+        variant = 'all_duplicates' if task['report_all_duplicates'] else ''
+        state_table = cache.load(path, variant) if cache else None
+        report['cached'] = state_table is not None
+        if state_table is None:
+            if extension == 'csv':
+                state_table = StateTable.from_csv(path)
+            elif extension == 'xlsx':
+                state_table = StateTable.from_excel(path)
+            elif extension == 'parquet':
+                state_table = StateTable.from_parquet(path)
+            else:
+                # The document is only kept for unpatched xml outputs, where it is written if the source changes meanwhile
+                keep_document = task['to'] == 'xml' and not task.get('patch')
+                state_table = StateTable.from_xml(path, stream=task['stream'], keep_document=keep_document)
+
+            StateTableChecker().check_for_errors(state_table, report_all_duplicates=task['report_all_duplicates'])
+            if cache:
+                cache.store(path, state_table, variant)
+
+        # The patch is applied after caching so the cache keeps the unpatched table
+        if task.get('patch'):
+            report['patch'] = state_table.apply_patch(task['patch'], report_all_duplicates=task['report_all_duplicates'])
+
+        report['rows'] = state_table.get_row_count()
+        report['errors'] = state_table.errors.counts()
+
+        to = task['to']
+        if to:
+            output = get_output_path(path, to, task['output_dir'])
+            if to == 'csv':
+                state_table.to_csv(output)
+            elif to == 'xlsx':
+                state_table.to_excel(output)
+            elif to == 'parquet':
+                state_table.to_parquet(output)
+            else:
+                state_table.to_xml(output, stream=task['stream'])
+            report['output'] = output
+    except Exception as e:
+        report['status'] = 'failed'
+        report['message'] = str(e)
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    if task.get('diagnostics'):
+        report['spans'] = instrumentation.to_list()
+        instrumentation.disable()
+    return report
+
+# Processes every task, in parallel when more than one job is requested, and returns the reports in input order
+def run_tasks(tasks: list, jobs: int=1) -> list:
+    if jobs <= 1 or len(tasks) <= 1:
+        return [process_file(task) for task in tasks]
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(process_file, tasks))
+
+# Builds the summary report with totals for the processed files
+def create_summary(command: str, reports: list, seconds: float) -> dict:
+    errors = {}
+    for report in reports:
+        for code, count in report.get('errors', {}).items():
+            errors[code] = errors.get(code, 0) + count
+
+    return {
+        'command': command,
+        'files': len(reports),
+        'failed': sum([1 for r in reports if r['status'] != 'ok']),
+        'files_with_errors': sum([1 for r in reports if r.get('errors')]),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'results': reports,
+    }
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='state_table_cli', description='Convert and validate Sepasoft state class exports and csv or excel state tables.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', help='Convert files to csv, xlsx, parquet or xml, validating them on the way')
+    convert.add_argument('--to', choices=EXTENSIONS, required=True, help='Output file type')
+    convert.add_argument('-o', '--output-dir', help='Directory for the converted files, defaults to each input file\'s directory')
+    convert.add_argument('--patch', help='Csv file of upserts and deletes keyed by Path applied to each input before converting')
+
+    validate = subparsers.add_parser('validate', help='Validate files without writing any output')
+
+    for subparser in [convert, validate]:
+        subparser.add_argument('inputs', nargs='+', help='Files, glob patterns or directories')
+        subparser.add_argument('-r', '--recursive', action='store_true', help='Search directories recursively')
+        subparser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes')
+        subparser.add_argument('--report', help='Write the json summary report to this file instead of stdout')
+        subparser.add_argument('--stream', action='store_true', help='Stream xml files instead of building element trees')
+        subparser.add_argument('--report-all-duplicates', action='store_true', help='Report every state sharing a duplicate code')
+        subparser.add_argument('--cache-dir', help='Reuse parsed and validated tables of unchanged files from this cache directory')
+        subparser.add_argument('--diagnostics', help='Write the time, rows and memory of each reading, checking and writing stage per file to this json file')
+        subparser.add_argument('--trace-memory', action='store_true', help='Record the peak memory of each stage in the diagnostics, slows the run down')
+        subparser.add_argument('--profile', help='Write a cProfile dump of the run to this file, files are processed in this process')
+
+    return parser
+
+# Runs the command line tool and returns the exit code
+# The exit code is 1 when a file fails, or when validating finds errors
+def main(argv: list=None) -> int:
+    args = create_parser().parse_args(argv)
+    paths = expand_inputs(args.inputs, args.recursive)
+    to = getattr(args, 'to', None)
+    output_dir = getattr(args, 'output_dir', None)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    tasks = [{
+        'path': path,
+        'to': to,
+        'output_dir': output_dir,
+        'stream': args.stream,
+        'report_all_duplicates': args.report_all_duplicates,
+        'cache_dir': args.cache_dir,
+        'patch': getattr(args, 'patch', None),
+        'diagnostics': bool(args.diagnostics),
+        'trace_memory': args.trace_memory,
+    } for path in paths]
+
+    start = time.perf_counter()
+    if args.profile:
+        profile = cProfile.Profile()
+        reports = profile.runcall(run_tasks, tasks, 1)
+        profile.dump_stats(args.profile)
+    else:
+        reports = run_tasks(tasks, args.jobs)
+    summary = create_summary(args.command, reports, time.perf_counter() - start)
+
+    if args.diagnostics:
+        files = [{'input': report['input'], 'spans': report.pop('spans', [])} for report in reports]
+        with open(args.diagnostics, 'w') as file:
+            json.dump({'command': args.command, 'files': files}, file, indent=2)
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(summary, file, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    for report in reports:
+        if report['status'] != 'ok':
+            status = f'{report["status"]}, {report["message"]}'
+        else:
+            status = ', '.join([f'{c} ({n})' for c, n in report['errors'].items()]) or 'ok'
+        print(f'{report["input"]}: {status}', file=sys.stderr)
+
+    if summary['failed'] or (args.command == 'validate' and summary['files_with_errors']):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
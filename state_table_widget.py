@@ -1,11 +1,16 @@
 import numpy as np
 import pandas as pd
 import sys
-from PySide6.QtCore import (QAbstractTableModel, Qt)
-from PySide6.QtWidgets import (QApplication, QHeaderView, QTableView, QVBoxLayout, QWidget)
-from state_table import StateTable
+from PySide6.QtCore import (QAbstractTableModel, QModelIndex, Qt, Signal)
+from PySide6.QtWidgets import (QApplication, QCheckBox, QHBoxLayout, QHeaderView, QLabel, QPushButton, QTableView, QVBoxLayout, QWidget)
+from conversions import boolean_text, set_value
+from instrumentation import instrumentation, span
+from state_table import IncrementalStateTableChecker, StateTable, StateTableDiff
 
 class StateTableWidget(QWidget):
+    # Emitted after an edit changed the state table's errors
+    errors_changed = Signal()
+
     def __init__(self, state_table: StateTable):
         super().__init__()
 
@@ -14,51 +19,183 @@ class StateTableWidget(QWidget):
 
         self.state_table = state_table
 
+        # Columns are sized from a sample of rows and rows use a fixed height so the view never reads every row
         self.table = QTableView()
-        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
         self.table.horizontalHeader().hideSection(0)
         self.table.horizontalHeader().hideSection(1)
         self.table.horizontalHeader().hideSection(11)
-        self.model = DataFrameTableModel(self.state_table.to_dataframe())
+        self.model = DataFrameTableModel(self.state_table.to_dataframe(), IncrementalStateTableChecker(self.state_table))
+        self.model.errors_changed.connect(self.errors_changed)
+        self.model.dataChanged.connect(self.state_table.mark_dirty)
+        self.table.setModel(self.model)
+        self.resize_columns()
+
+        self.layout.addWidget(self.table)
+
+    # Sets each column width from the header and a sample of the column's display values
+    def resize_columns(self, sample_size: int=200, max_width: int=400):
+        metrics = self.table.fontMetrics()
+        padding = 2 * metrics.horizontalAdvance('  ')
+        for col in range(self.model.columnCount()):
+            texts = [self.model.headerData(col, Qt.Orientation.Horizontal, Qt.ItemDataRole.DisplayRole)]
+            texts.extend(self.model.column_sample(col, sample_size))
+            width = max([metrics.horizontalAdvance(text) for text in texts]) + padding
+            self.table.setColumnWidth(col, min(width, max_width))
+
+# Shows the changes between two versions of a state table
+class StateTableDiffWidget(QWidget):
+    def __init__(self, diff: StateTableDiff, old_name: str='', new_name: str=''):
+        super().__init__()
+
+        self.setWindowTitle(f'Changes {old_name} -> {new_name}')
+        self.layout = QVBoxLayout(self)
+
+        self.diff = diff
+        self.summary_label = QLabel(diff.summary() or 'No changes')
+
+        self.table = QTableView()
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.model = DataFrameTableModel(diff.to_dataframe(), read_only=True)
         self.table.setModel(self.model)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        for col in range(self.model.columnCount()):
+            self.table.resizeColumnToContents(col)
+
+        self.layout.addWidget(self.summary_label)
+        self.layout.addWidget(self.table)
+
+# Shows the time, rows and peak memory of the recorded stages of opening, checking and writing files
+# Recording is off until it is turned on here, stage names are indented under their enclosing stage
+class DiagnosticsWidget(QWidget):
+    COLUMNS = ['name', 'seconds', 'rows', 'peak_mb', 'thread', 'start']
+
+    def __init__(self):
+        super().__init__()
+
+        self.setWindowTitle('Diagnostics')
+        self.layout = QVBoxLayout(self)
+
+        self.record_checkbox = QCheckBox('Record timings')
+        self.record_checkbox.setChecked(instrumentation.enabled)
+        self.record_checkbox.toggled.connect(self.recording_toggled)
+        self.memory_checkbox = QCheckBox('Trace memory (slower)')
+        self.memory_checkbox.setChecked(instrumentation.trace_memory)
+        self.memory_checkbox.toggled.connect(self.recording_toggled)
+        self.refresh_button = QPushButton('Refresh')
+        self.refresh_button.clicked.connect(self.refresh)
+        self.clear_button = QPushButton('Clear')
+        self.clear_button.clicked.connect(self.clear)
+
+        controls = QHBoxLayout()
+        controls.addWidget(self.record_checkbox)
+        controls.addWidget(self.memory_checkbox)
+        controls.addStretch()
+        controls.addWidget(self.refresh_button)
+        controls.addWidget(self.clear_button)
+
+        self.table = QTableView()
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.horizontalHeader().setStretchLastSection(True)
 
+        self.layout.addLayout(controls)
         self.layout.addWidget(self.table)
+        self.refresh()
 
+    # Turns recording on or off, memory tracing needs recording so it is restarted with it
+    def recording_toggled(self):
+        instrumentation.disable()
+        if self.record_checkbox.isChecked():
+            instrumentation.enable(trace_memory=self.memory_checkbox.isChecked())
+
+    # Shows the spans recorded so far
+    def refresh(self):
+        df = instrumentation.to_dataframe()
+        df['name'] = df['depth'].fillna(0).map(lambda depth: '    ' * depth) + df['name']
+        self.model = DataFrameTableModel(df.loc[:, self.COLUMNS], read_only=True)
+        self.table.setModel(self.model)
+        for col in range(self.model.columnCount()):
+            self.table.resizeColumnToContents(col)
+
+    def clear(self):
+        instrumentation.clear()
+        self.refresh()
+
+# Table model for previewing and editing a state table dataframe
+# Cell values are formatted into per column display lists when the model is created and rows are
+# handed to the view in chunks through canFetchMore/fetchMore
+# Edits to the columns watched by the incremental checker revalidate the affected rows, Path and NodeType are
+# read only when a checker is given since Path is derived from Parent and Name and both are indexed by the checker
 class DataFrameTableModel(QAbstractTableModel):
-    def __init__(self, df: pd.DataFrame):
+    CHUNK_SIZE = 1000
+    CHECKED_READ_ONLY_COLUMNS = ['Path', 'NodeType']
+    errors_changed = Signal()
+
+    def __init__(self, df: pd.DataFrame, checker: IncrementalStateTableChecker=None, read_only: bool=False):
         super(DataFrameTableModel, self).__init__()
         self._data = df
+        self._checker = checker
+        self._read_only = read_only
+        with span('model.format', rows=df.shape[0]):
+            self._display = [self._format_column(df.iloc[:, col]) for col in range(df.shape[1])]
+        self._alignment = [self._column_alignment(df.iloc[:, col]) for col in range(df.shape[1])]
+        self._loaded_rows = min(self.CHUNK_SIZE, df.shape[0])
     
     # Returns values and formatting for given index
     def data(self, index, role):
         if role in [Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole]:
-            value = self._data.iloc[index.row(), index.column()]
-            
-            if pd.isna(value):
-                return None
-            
-            if isinstance(value, (np.float64, np.int64)):
-                return  int(value)
-            
-            return str(value)
+            return self._display[index.column()][index.row()]
         
         if role == Qt.ItemDataRole.TextAlignmentRole:
-            value = self._data.iloc[index.row(), index.column()]
-
-            if isinstance(value, (np.float64, np.int64)):
-                return  Qt.AlignmentFlag.AlignVCenter + Qt.AlignmentFlag.AlignRight
+            return self._alignment[index.column()]
     
     # Updates the value at a given index
     def setData(self, index, value, role):
         if role == Qt.ItemDataRole.EditRole:
-            self._data.iloc[index.row(), index.column()] = value
+            row, col = index.row(), index.column()
+            if not self._is_editable(col):
+                return False
+            try:
+                value = self._coerce_value(self._data.iloc[:, col], value)
+            except ValueError:
+                return False
+            if self._checker and self._data.columns[col] in self._checker.COLUMNS:
+                rows = self._checker.set_value(row, self._data.columns[col], value)
+                self._refresh_rows(rows)
+                self.errors_changed.emit()
+                return True
+
+            set_value(self._data, row, col, value)
+            self._display[col][row] = self._format_value(self._data.iat[row, col])
+            self.dataChanged.emit(index, index, [role])
             return True
         
         return False
 
+    # Updates the display values of the given rows and notifies the view about the loaded ones
+    def _refresh_rows(self, rows: set):
+        for row in rows:
+            for col in range(self._data.shape[1]):
+                self._display[col][row] = self._format_value(self._data.iat[row, col])
+
+        loaded = [row for row in rows if row < self._loaded_rows]
+        if loaded:
+            self.dataChanged.emit(self.index(min(loaded), 0), self.index(max(loaded), self._data.shape[1] - 1))
+
     # Sets flats to enable selection and editing for values
     def flags(self, index):
+        if not self._is_editable(index.column()):
+            return Qt.ItemFlag.ItemIsSelectable|Qt.ItemFlag.ItemIsEnabled
         return Qt.ItemFlag.ItemIsSelectable|Qt.ItemFlag.ItemIsEnabled|Qt.ItemFlag.ItemIsEditable
+
+    # Helper function that checks if the values of a column can be edited
+    def _is_editable(self, col: int) -> bool:
+        if self._read_only:
+            return False
+        return not (self._checker and self._data.columns[col] in self.CHECKED_READ_ONLY_COLUMNS)
     
     # Returns header column names and row indexes for headers
     def headerData(self, section, orientation, role):
@@ -69,11 +206,70 @@ class DataFrameTableModel(QAbstractTableModel):
             if orientation == Qt.Orientation.Vertical:
                 return str(self._data.index[section])
 
-    def rowCount(self, index):
-        return self._data.shape[0]
+    def rowCount(self, index=QModelIndex()):
+        return 0 if index.isValid() else self._loaded_rows
+
+    def columnCount(self, index=QModelIndex()):
+        return 0 if index.isValid() else self._data.shape[1]
+
+    def canFetchMore(self, index):
+        return not index.isValid() and self._loaded_rows < self._data.shape[0]
+
+    # Hands the next chunk of rows to the view
+    def fetchMore(self, index):
+        if index.isValid():
+            return
+        count = min(self.CHUNK_SIZE, self._data.shape[0] - self._loaded_rows)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._loaded_rows, self._loaded_rows + count - 1)
+        self._loaded_rows += count
+        self.endInsertRows()
+
+    # Returns the display text of evenly spaced rows of a column for sizing the column
+    def column_sample(self, col: int, size: int) -> list:
+        values = self._display[col]
+        step = max(len(values) // size, 1)
+        return [str(v) for v in values[::step] if v is not None]
+
+    # Formats a column into its display values, flags are shown as true or false and missing values as None
+    def _format_column(self, column: pd.Series) -> list:
+        if pd.api.types.is_bool_dtype(column):
+            return boolean_text(column).tolist()
+
+        if pd.api.types.is_integer_dtype(column):
+            return [None if v is pd.NA else v for v in column.tolist()]
+
+        return column.astype(str).where(column.notna(), None).tolist()
+
+    # Formats a single value the same way as _format_column
+    def _format_value(self, value):
+        if pd.isna(value):
+            return None
+        if isinstance(value, (bool, np.bool_)):
+            return 'true' if value else 'false'
+        if isinstance(value, (int, np.integer)):
+            return int(value)
+        return str(value)
+
+    # Converts edited text to the column's type so edited values compare equal to loaded ones
+    # Raises ValueError for text that doesn't fit the column
+    def _coerce_value(self, column: pd.Series, value):
+        if value == '' and (pd.api.types.is_integer_dtype(column) or pd.api.types.is_bool_dtype(column)):
+            return pd.NA
+        if pd.api.types.is_bool_dtype(column):
+            flags = {'true': True, 'false': False}
+            if str(value).lower() not in flags:
+                raise ValueError(f'Invalid boolean value {value}')
+            return flags[str(value).lower()]
+        if pd.api.types.is_integer_dtype(column):
+            return int(value)
+        return value
 
-    def columnCount(self,index):
-        return self._data.shape[1]
+    # Integer columns are right aligned, other columns use the default alignment
+    def _column_alignment(self, column: pd.Series):
+        if pd.api.types.is_integer_dtype(column):
+            return Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignRight
 
 if __name__ == '__main__':
 
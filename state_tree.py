@@ -0,0 +1,299 @@
+import bisect
+import numpy as np
+import pandas as pd
+from array import array
+
+# Index of the state hierarchy of a state table
+# Nodes are the table's row positions and the root is node count (the row count). Each node's parent is the row
+# with its Parent path, the last row wins when paths are duplicated, and nodes whose parent path doesn't exist
+# get parent -1 and are kept as extra roots after the root's subtree.
+# Nodes are numbered in preorder so a subtree is the slice from its enter to its exit number of the order array,
+# children keep the row order.
+# Rows are matched to their parents through a path trie built from the Parent and Name columns, each distinct
+# parent path is split once and the Path column isn't read.
+class StateTree():
+    def __init__(self, parents: list, names: list, root: str='~') -> None:
+        self.root = len(parents)
+        self.trie = PathTrie()
+        parent_nodes, path_nodes = self.trie.add_rows(parents, names)
+        self.parent_nodes = np.array(parent_nodes, dtype=np.int64)
+
+        # rows maps path trie nodes to rows, the last row wins for duplicated paths and the root path to the root
+        root_node = self.trie.add(root)
+        self.rows = np.full(len(self.trie.parents), -1, dtype=np.int64)
+        last_nodes, last_rows = np.unique(np.array(path_nodes, dtype=np.int64)[::-1], return_index=True)
+        self.rows[last_nodes] = self.root - 1 - last_rows
+        if self.rows[root_node] < 0:
+            self.rows[root_node] = self.root
+        parent_ids = self.rows[self.parent_nodes].tolist() + [-1]
+        self.children = [[] for _ in range(self.root + 1)]
+        for node, parent in enumerate(parent_ids[:-1]):
+            if parent >= 0:
+                self.children[parent].append(node)
+
+        # Orphans start at the depth of their parent path so depths don't depend on missing rows
+        depth = [0] * (self.root + 1)
+        order = []
+        for top in [self.root] + [n for n, p in enumerate(parent_ids[:-1]) if p == -1]:
+            if top != self.root:
+                depth[top] = self.trie.depth[parent_nodes[top]] + 1
+            stack = [top]
+            while stack:
+                node = stack.pop()
+                order.append(node)
+                children = self.children[node]
+                if children:
+                    child_depth = depth[node] + 1
+                    for child in children:
+                        depth[child] = child_depth
+                    stack.extend(reversed(children))
+
+        size = [1] * (self.root + 1)
+        for node in reversed(order):
+            parent = parent_ids[node]
+            if parent >= 0:
+                size[parent] += size[node]
+
+        self.parent_ids = np.array(parent_ids, dtype=np.int64)
+        self.depth = np.array(depth, dtype=np.int64)
+        self.order = np.array(order, dtype=np.int64)
+        self.size = np.array(size, dtype=np.int64)
+        self._number()
+
+    # Numbers the nodes from their position in the preorder
+    def _number(self) -> None:
+        self.enter = np.empty(self.root + 1, dtype=np.int64)
+        self.enter[self.order] = np.arange(self.root + 1)
+        self.exit = self.enter + self.size
+
+    # Returns the rows whose parent path doesn't exist
+    def orphans(self) -> list:
+        return np.flatnonzero(self.parent_ids[:-1] == -1).tolist()
+
+    # Returns the node of a path or None
+    def node(self, path: str) -> int:
+        path_node = self.trie.find(path)
+        row = -1 if path_node is None else self.row(path_node)
+        return None if row < 0 else row
+
+    # Returns the node of the row with the path of a path trie node, or -1
+    def row(self, path_node: int) -> int:
+        return int(self.rows[path_node]) if path_node < len(self.rows) else -1
+
+    # Returns a node and its descendants in preorder
+    def subtree(self, node: int) -> np.ndarray:
+        return self.order[self.enter[node]:self.exit[node]]
+
+    def is_ancestor(self, ancestor: int, node: int) -> bool:
+        return self.enter[ancestor] <= self.enter[node] < self.exit[ancestor]
+
+    # Returns the ancestors of a node from its parent up to the root, or up to the top of an orphaned branch
+    def ancestors(self, node: int) -> list:
+        ancestors = []
+        parent = self.parent_ids[node]
+        while parent >= 0:
+            ancestors.append(int(parent))
+            parent = self.parent_ids[parent]
+        return ancestors
+
+    # Moves a node and its subtree under a new parent, keeping the children of the new parent in row order
+    # Returns the moved nodes, only the hierarchy is changed so the caller keeps the paths in step
+    def reparent(self, node: int, parent: int) -> np.ndarray:
+        if node == self.root or self.is_ancestor(node, parent):
+            raise Exception(f'Cannot move node {node} under node {parent}')
+
+        subtree = self.subtree(node).copy()
+        start, end = self.enter[node], self.exit[node]
+        old_parent = self.parent_ids[node]
+        if old_parent >= 0:
+            self.children[old_parent].remove(node)
+            for ancestor in [old_parent] + self.ancestors(old_parent):
+                self.size[ancestor] -= self.size[node]
+
+        # The subtree's slice of the preorder moves in front of its next sibling or to the end of the parent's subtree
+        siblings = self.children[parent]
+        index = bisect.bisect(siblings, node)
+        target = self.enter[siblings[index]] if index < len(siblings) else self.exit[parent]
+        if target >= end:
+            self.order = np.concatenate([self.order[:start], self.order[end:target], subtree, self.order[target:]])
+        else:
+            self.order = np.concatenate([self.order[:target], subtree, self.order[target:start], self.order[end:]])
+
+        siblings.insert(index, node)
+        self.parent_ids[node] = parent
+        for ancestor in [parent] + self.ancestors(parent):
+            self.size[ancestor] += self.size[node]
+        self.depth[subtree] += self.depth[parent] + 1 - self.depth[node]
+        self._number()
+        return subtree
+
+    # Updates the path to node map after the paths and parent paths of the given nodes were changed
+    def rename(self, nodes: list, old_paths: list, paths: list, parents: list) -> None:
+        for node, path in zip(nodes, old_paths):
+            path_node = self.trie.find(path)
+            if self.row(path_node) == node:
+                self.rows[path_node] = -1
+        for node, path, parent in zip(nodes, paths, parents):
+            path_node = self.trie.add(path)
+            if path_node >= len(self.rows):
+                self.rows = np.concatenate([self.rows, np.full(len(self.trie.parents) - len(self.rows), -1, dtype=np.int64)])
+            self.rows[path_node] = node
+            self.parent_nodes[node] = self.trie.add(parent)
+
+# Interned segments of a set of paths
+# Each distinct path and path prefix is a node numbered in the order it was added. Nodes are keyed by their parent
+# node and segment id and keep their depth, so ancestors and subtrees are walked on integers. Segment texts are
+# stored once and a node's path text is only joined from its segments when it is asked for. The children of the
+# nodes are only indexed once a subtree is asked for.
+# Node columns are int64 arrays, and the keys of nodes added together by add_rows are kept in an integer index
+# instead of the dictionary used for nodes added one at a time, so the trie doesn't hold an object per node.
+class PathTrie():
+    SEGMENT_BITS = 32
+    SEGMENT_MASK = (1 << SEGMENT_BITS) - 1
+
+    def __init__(self, separator: str='/') -> None:
+        self.separator = separator
+        self.segment_ids = {}
+        self.segments = []
+        self.nodes = {}
+        self.key_index = pd.Index([], dtype=np.int64)
+        self.key_nodes = np.empty(0, dtype=np.int64)
+        self.parents = array('q')
+        self.node_segments = array('q')
+        self.depth = array('q')
+        self.children = None
+
+    # Returns the id of a segment text, adding the segment when it is new
+    def segment(self, text: str) -> int:
+        segment_id = self.segment_ids.get(text)
+        if segment_id is None:
+            segment_id = self.segment_ids[text] = len(self.segments)
+            self.segments.append(text)
+        return segment_id
+
+    # Returns the node of a segment below a parent node, or at the top for parent -1, adding the node when it is new
+    def child(self, parent: int, segment_id: int) -> int:
+        key = (parent + 1) << self.SEGMENT_BITS | segment_id
+        node = self._get(key)
+        if node is None:
+            node = self.nodes[key] = len(self.parents)
+            self.parents.append(parent)
+            self.node_segments.append(segment_id)
+            self.depth.append(self.depth[parent] + 1 if parent >= 0 else 0)
+            if self.children is not None and parent >= 0:
+                self.children.setdefault(parent, []).append(node)
+        return node
+
+    # Returns the node of a path below a parent node, adding the path and any of its missing prefixes
+    def add(self, path: str, parent: int=-1) -> int:
+        node = parent
+        for text in path.split(self.separator):
+            node = self.child(node, self.segment(text))
+        return node
+
+    # Adds the paths of rows from their parent paths and names and returns the parent and path nodes of the rows
+    # Each distinct parent path is added once, below the node of its own parent path when that was seen already.
+    # The rows' nodes are then keyed by parent node and name segment and added together, names containing the
+    # separator are added one by one.
+    def add_rows(self, parents: list, names: list) -> tuple:
+        parent_codes, parent_paths = pd.factorize(pd.Series(parents, dtype=object), use_na_sentinel=False)
+        nodes = {}
+        for parent in parent_paths.tolist():
+            prefix, separator, last = str(parent).rpartition(self.separator)
+            prefix_node = nodes.get(prefix) if separator else None
+            if prefix_node is None:
+                nodes[parent] = self.add(str(parent))
+            else:
+                nodes[parent] = self.add(last, prefix_node)
+        parent_nodes = np.array(list(nodes.values()), dtype=np.int64)[parent_codes]
+
+        name_codes, unique_names = pd.factorize(pd.Series(names, dtype=object), use_na_sentinel=False)
+        unique_names = unique_names.tolist()
+        simple = np.array([isinstance(n, str) and self.separator not in n for n in unique_names], dtype=bool)
+        segment_ids = np.array([self.segment(n) if s else 0 for n, s in zip(unique_names, simple)], dtype=np.int64)
+        simple_rows = simple[name_codes]
+
+        path_nodes = np.empty(len(parent_nodes), dtype=np.int64)
+        rows = np.flatnonzero(simple_rows)
+        keys = (parent_nodes[rows] + 1) << self.SEGMENT_BITS | segment_ids[name_codes[rows]]
+        key_codes, unique_keys = pd.factorize(keys)
+        path_nodes[rows] = self._add_keys(unique_keys)[key_codes]
+        for row in np.flatnonzero(~simple_rows).tolist():
+            path_nodes[row] = self.add(str(names[row]), int(parent_nodes[row]))
+        return parent_nodes.tolist(), path_nodes.tolist()
+
+    # Helper function that returns the node of a key or None
+    def _get(self, key: int) -> int:
+        node = self.nodes.get(key)
+        if node is None and len(self.key_nodes) > 0 and key in self.key_index:
+            node = int(self.key_nodes[self.key_index.get_loc(key)])
+        return node
+
+    # Helper function that returns the nodes of parent node and segment keys, adding the missing ones together
+    def _add_keys(self, keys: np.ndarray) -> np.ndarray:
+        found = pd.Series(keys).map(self.nodes).fillna(-1).to_numpy(dtype=np.int64)
+        if len(self.key_index) > 0:
+            locs = self.key_index.get_indexer(keys)
+            found = np.where(locs >= 0, self.key_nodes[locs], found)
+        new = np.flatnonzero(found < 0)
+        if len(new) == 0:
+            return found
+
+        start = len(self.parents)
+        found[new] = np.arange(start, start + len(new))
+        new_keys = keys[new]
+        parents = (new_keys >> self.SEGMENT_BITS) - 1
+        self.key_index = self.key_index.append(pd.Index(new_keys))
+        self.key_nodes = np.concatenate([self.key_nodes, found[new]])
+        self.parents.frombytes(parents.astype(np.int64).tobytes())
+        self.node_segments.frombytes((new_keys & self.SEGMENT_MASK).astype(np.int64).tobytes())
+        self.depth.frombytes((np.array(self.depth, dtype=np.int64)[parents] + 1).tobytes())
+        if self.children is not None:
+            for parent, node in zip(parents.tolist(), found[new].tolist()):
+                self.children.setdefault(parent, []).append(node)
+        return found
+
+    # Returns the node of a path or None when it was never added
+    def find(self, path: str) -> int:
+        node = -1
+        for text in path.split(self.separator):
+            segment_id = self.segment_ids.get(text)
+            if segment_id is None:
+                return None
+            node = self._get((node + 1) << self.SEGMENT_BITS | segment_id)
+            if node is None:
+                return None
+        return node
+
+    # Joins the path text of a node from its segments
+    def path(self, node: int) -> str:
+        segments = []
+        while node >= 0:
+            segments.append(self.segments[self.node_segments[node]])
+            node = self.parents[node]
+        return self.separator.join(reversed(segments))
+
+    # Returns the ancestors of a node from its parent up to its top segment
+    def ancestors(self, node: int) -> list:
+        ancestors = []
+        node = self.parents[node]
+        while node >= 0:
+            ancestors.append(node)
+            node = self.parents[node]
+        return ancestors
+
+    # Returns a node and every node below it
+    def subtree(self, node: int) -> list:
+        if self.children is None:
+            self.children = {}
+            for child, parent in enumerate(self.parents):
+                if parent >= 0:
+                    self.children.setdefault(parent, []).append(child)
+
+        nodes = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(self.children.get(node, []))
+        return nodes
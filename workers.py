@@ -0,0 +1,110 @@
+import os
+from PySide6.QtCore import (QObject, QRunnable, Signal)
+from instrumentation import span
+from parse_cache import ParseCache
+from state_table import StateTable, StateTableChecker
+
+# Signals emitted by the background workers, delivered to the GUI thread through queued connections
+class WorkerSignals(QObject):
+    finished = Signal(int, object, str)
+    error = Signal(int, str)
+    progress = Signal(int, int)
+    cancelled = Signal(int)
+
+# Creates and validates a state table from a file on a thread pool thread
+# The open files table row is carried through so results arriving in completion order update the right row
+# Unchanged files are loaded from the parse cache when one is given
+class OpenFileWorker(QRunnable):
+    def __init__(self, row: int, path: str, extension: str, state_table_checker: StateTableChecker, parse_cache: ParseCache=None):
+        super().__init__()
+        self.row = row
+        self.path = path
+        self.extension = extension
+        self.state_table_checker = state_table_checker
+        self.parse_cache = parse_cache
+        self.signals = WorkerSignals()
+
+    # Reading the file is reported as the first 90 percent of the progress and validation as the rest
+    def run(self):
+        read_progress = lambda percent: self.signals.progress.emit(self.row, percent * 9 // 10)
+        check_progress = lambda percent: self.signals.progress.emit(self.row, 90 + percent // 10)
+        try:
+            with span('open') as current:
+                state_table = self.parse_cache.load(self.path) if self.parse_cache else None
+                if state_table is None:
+                    if self.extension == 'csv':
+                        state_table = StateTable.from_csv(self.path, progress=read_progress)
+                    elif self.extension == 'xlsx':
+                        state_table = StateTable.from_excel(self.path, progress=read_progress)
+                    else:
+                        state_table = StateTable.from_xml(self.path, progress=read_progress)
+
+                    self.state_table_checker.check_for_errors(state_table, progress=check_progress)
+                    if self.parse_cache:
+                        with span('cache.store'):
+                            self.parse_cache.store(self.path, state_table)
+                current.rows = state_table.get_row_count()
+        except Exception as e:
+            self.signals.error.emit(self.row, str(e))
+            return
+
+        message = state_table.errors.summary() if state_table.errors else ''
+        self.signals.finished.emit(self.row, state_table, message)
+
+# Raised from the progress callback of a cancelled export to stop the writer
+class ExportCancelled(Exception):
+    pass
+
+# Writes a state table to a csv, excel or xml file on a thread pool thread
+# The table is written to a temporary file next to the target that replaces the target once it is complete,
+# so a cancelled or failed export never leaves a partial file or touches an existing one. The writer is stopped
+# at its next progress report once the export is cancelled. Xml files are streamed so concurrent exports don't
+# hold element trees.
+# The worker writes a snapshot of the table taken when it is created, so the preview can keep editing the table
+# and the export doesn't update the table's cached state from the pool thread.
+class ExportWorker(QRunnable):
+    def __init__(self, row: int, state_table: StateTable, path: str, extension: str):
+        super().__init__()
+        self.row = row
+        self.state_table = state_table.snapshot()
+        self.path = path
+        self.extension = extension
+        self.cancelled = False
+        self.signals = WorkerSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        def progress(percent):
+            if self.cancelled:
+                raise ExportCancelled()
+            self.signals.progress.emit(self.row, percent)
+
+        temp_path = None
+        try:
+            if self.cancelled:
+                raise ExportCancelled()
+            temp_path = f'{self.path}.tmp'
+            with span('export', rows=self.state_table.get_row_count()):
+                if self.extension == 'xlsx':
+                    self.state_table.to_excel(temp_path, progress=progress)
+                elif self.extension == 'csv':
+                    self.state_table.to_csv(temp_path, progress=progress)
+                else:
+                    self.state_table.to_xml(temp_path, stream=True, progress=progress)
+            os.replace(temp_path, self.path)
+        except ExportCancelled:
+            self._remove(temp_path)
+            self.signals.cancelled.emit(self.row)
+            return
+        except Exception as e:
+            self._remove(temp_path)
+            self.signals.error.emit(self.row, str(e))
+            return
+
+        self.signals.finished.emit(self.row, self.state_table, self.path)
+
+    def _remove(self, path: str):
+        if path and os.path.exists(path):
+            os.remove(path)